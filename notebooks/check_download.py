@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Check of download_input, from pipeline_helpers.py, against a local
+http.server that serves a known payload and fails on demand.
+
+It covers resuming a ".part" file with an HTTP range request, retrying
+responses with a status in RETRY_STATUS_CODES and connections closed before
+the whole body is sent, and rejecting a download whose sha256 does not match
+the expected one. No remote server is contacted.
+
+Usage:
+    python check_download.py
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterator, List, Optional
+
+from pipeline_helpers import download_input, fetch_session
+
+
+PAYLOAD = bytes(range(256)) * 4096
+PAYLOAD_SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """
+    Serves PAYLOAD, honouring "Range: bytes=start-" headers. Each request
+    takes the next entry of the server's failures: a status code to answer
+    with, or "truncate" to close the connection after sending half of the
+    body. Once they are exhausted every request is served. The Range header
+    of every request, or None, is recorded in the server's ranges.
+    """
+
+    def do_GET(self) -> None:
+        self.server.ranges.append(self.headers.get("Range"))
+        failure = self.server.failures.pop(0) if self.server.failures else None
+        if isinstance(failure, int):
+            self.send_error(failure)
+            return
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+        if start >= len(PAYLOAD):
+            self.send_error(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            return
+        body = PAYLOAD[start:]
+        self.send_response(HTTPStatus.PARTIAL_CONTENT if start else
+                           HTTPStatus.OK)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if failure == "truncate":
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+@contextmanager
+def flaky_server(failures: Optional[List[Any]] = None) -> Iterator[Any]:
+    """
+    Runs a FlakyHandler server on a free local port with the given @failures
+    while the context is active, and yields it.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    server.failures = list(failures or [])
+    server.ranges = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def expect(condition: bool, message: str) -> None:
+    """
+    Raises an AssertionError with @message if @condition does not hold.
+    """
+    if not condition:
+        raise AssertionError(message)
+
+
+def read_file(path: str) -> bytes:
+    """
+    Returns the contents of the file in @path.
+    """
+    with open(path, "rb") as input_file:
+        return input_file.read()
+
+
+def check_range_resume(directory: str) -> None:
+    """
+    A ".part" file left by an interrupted download is completed with a single
+    range request for the missing bytes.
+    """
+    path = os.path.join(directory, "resume.bin")
+    with open(path + ".part", "wb") as part:
+        part.write(PAYLOAD[:100000])
+    with flaky_server() as server:
+        spec = {"url": f"http://127.0.0.1:{server.server_port}/resume.bin",
+                "sha256": PAYLOAD_SHA256}
+        checksum = download_input(fetch_session(), spec, path, backoff=0)
+    expect(server.ranges == ["bytes=100000-"],
+           f"Expected one range request, got {server.ranges}")
+    expect(checksum == PAYLOAD_SHA256, "Wrong checksum after resuming")
+    expect(read_file(path) == PAYLOAD, "Wrong contents after resuming")
+    expect(not os.path.exists(path + ".part"), "The part file was left")
+
+
+def check_retry(directory: str) -> None:
+    """
+    A 503 response is retried, and a connection closed before the end of the
+    body is retried with a range request from the blocks already written,
+    while a sink receives every byte exactly once.
+    """
+    path = os.path.join(directory, "retry.bin")
+    sink_path = os.path.join(directory, "retry.sink")
+    with flaky_server([HTTPStatus.SERVICE_UNAVAILABLE, "truncate"]) as server:
+        spec = {"url": f"http://127.0.0.1:{server.server_port}/retry.bin"}
+        with open(sink_path, "wb") as sink:
+            checksum = download_input(fetch_session(), spec, path, sink=sink,
+                                      backoff=0, chunk_size=1 << 14)
+    expect(server.ranges[:2] == [None, None] and len(server.ranges) == 3 and
+           0 < int(server.ranges[2][6:-1]) <= len(PAYLOAD) // 2,
+           f"Unexpected requests {server.ranges}")
+    expect(checksum == PAYLOAD_SHA256, "Wrong checksum after retrying")
+    expect(read_file(path) == PAYLOAD, "Wrong contents after retrying")
+    expect(read_file(sink_path) == PAYLOAD, "Wrong bytes sent to the sink")
+
+
+def check_exhausted_retries(directory: str) -> None:
+    """
+    A status in RETRY_STATUS_CODES is raised once @retries are exhausted.
+    """
+    path = os.path.join(directory, "exhausted.bin")
+    with flaky_server([HTTPStatus.SERVICE_UNAVAILABLE] * 3) as server:
+        spec = {"url": f"http://127.0.0.1:{server.server_port}/exhausted.bin"}
+        try:
+            download_input(fetch_session(), spec, path, retries=2, backoff=0)
+        except Exception as error:
+            status = getattr(getattr(error, "response", None), "status_code",
+                             None)
+            expect(status == HTTPStatus.SERVICE_UNAVAILABLE,
+                   f"Unexpected error {error!r}")
+        else:
+            raise AssertionError("The download did not fail")
+    expect(len(server.ranges) == 3,
+           f"Expected 3 attempts, got {len(server.ranges)}")
+
+
+def check_checksum_mismatch(directory: str) -> None:
+    """
+    A download whose sha256 differs from the expected one raises ValueError,
+    and neither the file nor its ".part" file are kept.
+    """
+    path = os.path.join(directory, "mismatch.bin")
+    with flaky_server() as server:
+        spec = {"url": f"http://127.0.0.1:{server.server_port}/mismatch.bin",
+                "sha256": "0" * 64}
+        try:
+            download_input(fetch_session(), spec, path, backoff=0)
+        except ValueError as error:
+            expect("Checksum mismatch" in str(error),
+                   f"Unexpected error {error!r}")
+        else:
+            raise AssertionError("The checksum mismatch was not detected")
+    expect(not os.path.exists(path), "The mismatched file was kept")
+    expect(not os.path.exists(path + ".part"), "The part file was kept")
+
+
+CHECKS = [check_range_resume, check_retry, check_exhausted_retries,
+          check_checksum_mismatch]
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        for check in CHECKS:
+            check(directory)
+            print(f"{check.__name__}: ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -15,7 +15,6 @@
 #     language: python
 #     name: python3
 # ---
-
 # %% [markdown]
 """
 # Diplomatura en Ciencias de Datos, Aprendizaje Automático y sus Aplicaciones
@@ -29,7 +28,12 @@ Autores: Matías Oria, Antonela Sambuceti, Pamela Pairo, Benjamín Ocampo
 Se trabajó sobre los *dataframes* `melb_suburb_df` y `melb_housing_df` que
 fueron obtenidos en el archivo `combine_airbnb_dataset.ipynb` de este mismo
 repositorio siendo alojados en un servidor de la Universidad Nacional de Córdoba
-para facilitar su acceso remoto.
+para facilitar su acceso remoto. Ambos archivos, junto con los límites de las
+regiones de Victoria, se descargan en paralelo con `fetch_inputs` y se guardan
+en `FETCH_DIR`, de modo que las siguientes ejecuciones los leen desde el disco.
+Las funciones compartidas con las otras *notebooks* (descargas, medición de
+etapas, valores faltantes y escritura de particiones) se importan de
+`notebooks/pipeline_helpers.py`.
 """
 # %% [markdown]
 """
@@ -43,25 +47,66 @@ es necesario.
 # %%
 # !pip install geopandas
 # %%
-from typing import Tuple, List, Optional
+from typing import Any, Dict, Tuple, List, Optional, Sequence
+from functools import lru_cache, partial
+import json
+import os
+import pickle
+import sys
 import pandas as pd
 import numpy as np
 import seaborn
 import matplotlib.pyplot as plt
 import geopandas as gpd
-import requests
-import missingno as msno
+sys.path.insert(0, os.path.abspath(os.pardir))
+from pipeline_helpers import (MELB_HOUSING_FILTERED_PARTITIONS,
+                              MELB_HOUSING_PARTITIONS,
+                              MELB_SUBURB_FILTERED_PARTITIONS,
+                              MELB_SUBURB_PARTITIONS, clear_column_statistics,
+                              column_statistics, fetch_input, fetch_inputs,
+                              fetch_session, missingness_summary,
+                              partition_path, plot_missingness_bar, shape_of,
+                              track_stage, write_partition,
+                              write_stage_report)
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+ARROW_STRING = "string[pyarrow]" if pyarrow is not None else "string"
+HOUSING_TEXT_DTYPES = {
+    "housing_address": ARROW_STRING,
+    "housing_seller_agency": "category",
+}
 
 
-def clean_outliers(df: pd.DataFrame,
-                   column_name: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+def outlier_bounds(col: pd.Series,
+                   token: Any = None) -> Tuple[float, float]:
+    """
+    Returns the interval of values of @col which are at most 2.5 times
+    standard deviations apart from the mean, taken from column_statistics
+    and cached under @token if given.
+    """
+    statistics = column_statistics(col, token, ("mean", "std"))
+    return (statistics["mean"] - 2.5 * statistics["std"],
+            statistics["mean"] + 2.5 * statistics["std"])
+
+
+def clean_outliers(
+    df: pd.DataFrame,
+    column_name: str,
+    bounds: Optional[Tuple[float, float]] = None
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     Filters out entries of @df that have in @column_name values which are 2.5
     times standard deviations apart from the mean. Returns both, entries that
-    hold and miss the condition.
+    hold and miss the condition. If @bounds is provided, it is used as the
+    interval of valid values instead, as given by outlier_bounds.
     """
     col = df[column_name]
-    mask_outlier = np.abs(col - col.mean()) <= (2.5 * col.std())
+    low, high = outlier_bounds(col) if bounds is None else bounds
+    mask_outlier = (col >= low) & (col <= high)
     return df[mask_outlier], df[~mask_outlier]
 
 
@@ -82,38 +127,48 @@ def to_categorical(column: pd.Series, bin_size: int, min_cut: int,
     return pd.cut(column, pd.IntervalIndex.from_tuples(intervals))
 
 
-def plot_melbourne_map(locations_df: gpd.GeoDataFrame,
-                       key_regions: List[str],
-                       column_name_colorbar: Optional[str] = None) -> None:
+REGION_BOUNDARIES_ROUTE = (
+    "vic-state-electoral-boundaries-psma-administrative-boundaries")
+REGION_BOUNDARIES_PROJECTION = "EPSG:3110"
+REGION_BOUNDARIES_INPUT = {
+    "url": f"https://data.gov.au/geoserver/{REGION_BOUNDARIES_ROUTE}/wfs",
+    "params": dict(service="WFS",
+                   version="2.0.0",
+                   request="GetFeature",
+                   typeName=(REGION_BOUNDARIES_ROUTE +
+                             ":ckan_a0d8838b_2423_4c8b_a7d9_b04eb240a2b1"),
+                   outputFormat="json"),
+    "filename": "vic_region_boundaries.json",
+}
+
+
+@lru_cache(maxsize=None)
+def get_region_boundaries(key_regions: Tuple[str, ...]) -> gpd.GeoDataFrame:
     """
-    Plots a map of the surroundings of Melbourne, displaying the regions given
-    by @key_regions. @location_df needs to be a geodataframe that contains the
-    latitude and longitude as pandas points, so they can be superimposed on the
-    background map. If @column_name_colorbar is provided, it needs to be the
-    name of a column of @locations_df. Then, it colors the points and adds a
-    colorbar indicating the magnitude of the values contained in that column.
+    Returns the geometries of the regions of the Territory of Victoria given by
+    @key_regions, dissolved by region name. Boundaries are downloaded from the
+    WFS service of data.gov.au with fetch_input, so they are read from disk
+    after the first download, and following calls with the same regions are
+    served from memory.
     """
-    geoserver = "https://data.gov.au/geoserver"
-    route = "vic-state-electoral-boundaries-psma-administrative-boundaries"
-    service = "wfs"
-    projection = "EPSG:3110"
-    wfsurl = f"{geoserver}/{route}/{service}"
-
-    params = dict(service="WFS",
-                  version="2.0.0",
-                  request="GetFeature",
-                  typeName=(route +
-                            ":ckan_a0d8838b_2423_4c8b_a7d9_b04eb240a2b1"),
-                  outputFormat="json")
-    features = requests.get(wfsurl, params=params).json()
+    features = fetch_input(fetch_session(1), REGION_BOUNDARIES_INPUT,
+                           json.load)
     region_location_df = gpd.GeoDataFrame.from_features(features).set_crs(
-        projection)
+        REGION_BOUNDARIES_PROJECTION)
 
     only_key_regions = region_location_df["vic_stat_2"].isin(key_regions)
-    region_location_df = (
+    return (
         region_location_df.loc[only_key_regions,
                                ["vic_stat_2", "geometry"]].dissolve(
                                    by="vic_stat_2").reset_index())
+
+
+def plot_region_background(key_regions: List[str]) -> plt.Axes:
+    """
+    Plots the boundaries of the regions given by @key_regions and returns the
+    axes where they were drawn, so other layers can be superimposed on them.
+    """
+    region_location_df = get_region_boundaries(tuple(key_regions))
     background = region_location_df.plot(column="vic_stat_2",
                                          edgecolor="black",
                                          figsize=(15, 15),
@@ -121,6 +176,35 @@ def plot_melbourne_map(locations_df: gpd.GeoDataFrame,
     plt.ylabel("Latitude")
     plt.xlabel("Longitude")
     background.set(title="Regiones del Territorio de Victoria, Australia")
+    return background
+
+
+def add_colorbar(ax: plt.Axes, cmap, vmin: float, vmax: float,
+                 title: str) -> None:
+    """
+    Adds to the figure of @ax a colorbar with the colors of @cmap ranging from
+    @vmin to @vmax.
+    """
+    fig = ax.get_figure()
+    cbax = fig.add_axes([0.95, 0.2, 0.04, 0.60])
+    cbax.set_title(title)
+    sm = plt.cm.ScalarMappable(cmap=cmap,
+                               norm=plt.Normalize(vmin=vmin, vmax=vmax))
+    fig.colorbar(sm, cax=cbax, format="%d")
+
+
+def plot_melbourne_map(locations_df: gpd.GeoDataFrame,
+                       key_regions: List[str],
+                       column_name_colorbar: Optional[str] = None) -> None:
+    """
+    Plots a map of the surroundings of Melbourne, displaying the regions given
+    by @key_regions. @location_df needs to be a geodataframe that contains the
+    latitude and longitude as pandas points, so they can be superimposed on the
+    background map. If @column_name_colorbar is provided, it needs to be the
+    name of a column of @locations_df. Then, it colors the points and adds a
+    colorbar indicating the magnitude of the values contained in that column.
+    """
+    background = plot_region_background(key_regions)
 
     if column_name_colorbar is not None:
         cmap = seaborn.color_palette("flare", as_cmap=True)
@@ -129,26 +213,471 @@ def plot_melbourne_map(locations_df: gpd.GeoDataFrame,
                                    markersize=3,
                                    column=column_name_colorbar,
                                    cmap=cmap)
-
-        fig = points.get_figure()
-        cbax = fig.add_axes([0.95, 0.2, 0.04, 0.60])
-        cbax.set_title(column_name_colorbar)
-        sm = plt.cm.ScalarMappable(
-            cmap=cmap,
-            norm=plt.Normalize(vmin=min(locations_df[column_name_colorbar]),
-                               vmax=max(locations_df[column_name_colorbar])))
-        fig.colorbar(sm, cax=cbax, format="%d")
+        add_colorbar(points, cmap, locations_df[column_name_colorbar].min(),
+                     locations_df[column_name_colorbar].max(),
+                     column_name_colorbar)
     else:
         points = locations_df.plot(ax=background,
                                    marker="o",
                                    markersize=3,
                                    color="r")
+
+
+def rasterize_locations(longitudes: np.ndarray,
+                        latitudes: np.ndarray,
+                        values: Optional[np.ndarray] = None,
+                        statistic: str = "count",
+                        resolution: int = 400,
+                        extent: Optional[Tuple[float, float, float,
+                                               float]] = None
+                        ) -> Tuple[np.ndarray, Tuple[float, float, float,
+                                                     float]]:
+    """
+    Bins the points given by @longitudes and @latitudes into a grid of
+    @resolution cells along its widest side. Returns the grid and its extent
+    (min_lon, max_lon, min_lat, max_lat). If @statistic is "count" each cell
+    holds the number of points inside it, if it is "mean" or "sum" it holds that
+    statistic of @values. Cells without points are NaN except for counts. If
+    @extent is not provided, the bounding box of the points is used.
+    """
+    if statistic not in ("count", "mean", "sum"):
+        raise ValueError(f"Unknown statistic {statistic}")
+    if values is None and statistic != "count":
+        raise ValueError(f"Statistic {statistic} requires values")
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    if extent is None:
+        extent = (np.nanmin(longitudes), np.nanmax(longitudes),
+                  np.nanmin(latitudes), np.nanmax(latitudes))
+    min_lon, max_lon, min_lat, max_lat = extent
+    lon_span = max(max_lon - min_lon, np.finfo(np.float64).eps)
+    lat_span = max(max_lat - min_lat, np.finfo(np.float64).eps)
+    scale = resolution / max(lon_span, lat_span)
+    width = max(int(np.ceil(lon_span * scale)), 1)
+    height = max(int(np.ceil(lat_span * scale)), 1)
+
+    cols = np.floor((longitudes - min_lon) * scale).astype(np.int64)
+    rows = np.floor((latitudes - min_lat) * scale).astype(np.int64)
+    # Points lying exactly on the upper border belong to the last cell.
+    cols[cols == width] = width - 1
+    rows[rows == height] = height - 1
+    inside = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+    if values is not None:
+        values = np.asarray(values, dtype=np.float64)
+        inside &= ~np.isnan(values)
+    cells = rows[inside] * width + cols[inside]
+
+    counts = np.bincount(cells, minlength=width * height)
+    if statistic == "count":
+        grid = counts.astype(np.float64)
+    else:
+        sums = np.bincount(cells, weights=values[inside],
+                           minlength=width * height)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            grid = sums / counts if statistic == "mean" else sums
+        grid[counts == 0] = np.nan
+    return grid.reshape(height, width), extent
+
+
+def plot_melbourne_raster(locations_df: pd.DataFrame,
+                          key_regions: List[str],
+                          column_name_colorbar: Optional[str] = None,
+                          statistic: str = "mean",
+                          resolution: int = 400) -> None:
+    """
+    Aggregated version of plot_melbourne_map for large amounts of points.
+    Instead of drawing a marker per row of @locations_df, its locations
+    (columns housing_longitude and housing_lattitude) are binned into a grid of
+    @resolution cells by rasterize_locations and the resulting image is drawn
+    over the regions given by @key_regions. If @column_name_colorbar is
+    provided, each cell shows @statistic of that column, otherwise the amount of
+    sales that fall on it.
+    """
+    background = plot_region_background(key_regions)
+    values = None
+    if column_name_colorbar is None:
+        statistic = "count"
+    else:
+        values = locations_df[column_name_colorbar].to_numpy()
+    grid, extent = rasterize_locations(
+        locations_df["housing_longitude"].to_numpy(),
+        locations_df["housing_lattitude"].to_numpy(),
+        values=values,
+        statistic=statistic,
+        resolution=resolution)
+    if statistic == "count":
+        grid[grid == 0] = np.nan
+
+    cmap = seaborn.color_palette("flare", as_cmap=True)
+    vmin, vmax = np.nanmin(grid), np.nanmax(grid)
+    background.imshow(grid,
+                      origin="lower",
+                      extent=extent,
+                      cmap=cmap,
+                      vmin=vmin,
+                      vmax=vmax,
+                      interpolation="nearest",
+                      zorder=2)
+    add_colorbar(background, cmap, vmin, vmax,
+                 column_name_colorbar or "housing_count")
+
+
+def factorize_columns(df: pd.DataFrame,
+                      columns: List[str]) -> Dict[str, Tuple[np.ndarray,
+                                                              pd.Index]]:
+    """
+    Factorizes each column of @columns in @df only once. Returns a dictionary
+    that maps every column name to a pair (codes, uniques) as given by
+    pd.factorize. Null entries are coded as -1.
+    """
+    return {col: pd.factorize(df[col], sort=True) for col in columns}
+
+
+def combine_codes(factorized: Dict[str, Tuple[np.ndarray, pd.Index]],
+                  dimensions: Tuple[str, ...]) -> Tuple[np.ndarray,
+                                                        np.ndarray]:
+    """
+    Combines the codes of @dimensions in @factorized into a single integer key
+    per row, using each dimension cardinality as radix. Returns the combined key
+    of each row and a mask of the rows that have no null dimension.
+    """
+    valid = np.ones(len(factorized[dimensions[0]][0]), dtype=bool)
+    keys = np.zeros(len(valid), dtype=np.int64)
+    for dim in dimensions:
+        codes, uniques = factorized[dim]
+        valid &= codes >= 0
+        keys = keys * len(uniques) + codes
+    return keys, valid
+
+
+def decode_codes(factorized: Dict[str, Tuple[np.ndarray, pd.Index]],
+                 dimensions: Tuple[str, ...],
+                 keys: np.ndarray) -> pd.Index:
+    """
+    Inverse of combine_codes. Returns an index with the values of @dimensions
+    that correspond to each combined key in @keys.
+    """
+    dim_values = []
+    remainder = np.asarray(keys)
+    for dim in reversed(dimensions):
+        uniques = factorized[dim][1]
+        dim_values.append(uniques.take(remainder % len(uniques)))
+        remainder = remainder // len(uniques)
+    if len(dimensions) == 1:
+        return pd.Index(dim_values[0], name=dimensions[0])
+    return pd.MultiIndex.from_arrays(dim_values[::-1], names=list(dimensions))
+
+
+def build_stats_cube(df: pd.DataFrame,
+                     value_col: str,
+                     dimension_sets: List[Tuple[str, ...]],
+                     bin_edges: Optional[np.ndarray] = None,
+                     nof_bins: int = 256) -> Dict[Tuple[str, ...],
+                                                  pd.DataFrame]:
+    """
+    Computes statistics of @value_col grouped by every tuple of columns in
+    @dimension_sets. Each dimension is factorized once and each grouping is
+    reduced in a single pass with np.bincount and ufunc reductions, without
+    pandas groupby. Returns a dictionary that maps each tuple of dimensions to
+    a dataframe indexed by their values with the columns count, sum, sum_sq,
+    min, max, and a histogram of @value_col over @bin_edges (bin_<i> columns)
+    used to approximate quantiles. If @bin_edges is not given, @nof_bins
+    logarithmic bins between the minimum and maximum of @value_col are used.
+    Histograms are mergeable, so cubes of different batches can be combined
+    with update_stats_cube.
+    """
+    values = df[value_col].to_numpy(dtype=np.float64)
+    known = ~np.isnan(values)
+    if bin_edges is None:
+        low, high = values[known].min(), values[known].max()
+        bin_edges = (np.geomspace(low, high, nof_bins + 1)
+                     if low > 0 else np.linspace(low, high, nof_bins + 1))
+    nof_bins = len(bin_edges) - 1
+    value_bins = np.clip(
+        np.searchsorted(bin_edges, values, side="right") - 1, 0,
+        nof_bins - 1)
+
+    dimensions = sorted({dim for dims in dimension_sets for dim in dims})
+    factorized = factorize_columns(df, dimensions)
+
+    cube = {}
+    for dims in dimension_sets:
+        keys, valid = combine_codes(factorized, dims)
+        valid &= known
+        group_ids, group_keys = pd.factorize(keys[valid], sort=True)
+        group_values = values[valid]
+        nof_groups = len(group_keys)
+
+        order = np.argsort(group_ids, kind="stable")
+        starts = np.searchsorted(group_ids[order], np.arange(nof_groups))
+        sorted_values = group_values[order]
+        histogram = np.bincount(
+            group_ids * nof_bins + value_bins[valid],
+            minlength=nof_groups * nof_bins).reshape(nof_groups, nof_bins)
+
+        stats_df = pd.DataFrame({
+            "count": np.bincount(group_ids, minlength=nof_groups),
+            "sum": np.bincount(group_ids, weights=group_values,
+                               minlength=nof_groups),
+            "sum_sq": np.bincount(group_ids, weights=group_values**2,
+                                  minlength=nof_groups),
+            "min": np.minimum.reduceat(sorted_values, starts)
+                   if nof_groups else np.empty(0),
+            "max": np.maximum.reduceat(sorted_values, starts)
+                   if nof_groups else np.empty(0),
+        })
+        stats_df = pd.concat([
+            stats_df,
+            pd.DataFrame(histogram,
+                         columns=[f"bin_{i}" for i in range(nof_bins)])
+        ], axis=1)
+
+        stats_df.index = decode_codes(factorized, dims, group_keys)
+        stats_df.attrs["bin_edges"] = tuple(bin_edges)
+        cube[dims] = stats_df
+    return cube
+
+
+def update_stats_cube(cube: Dict[Tuple[str, ...], pd.DataFrame],
+                      new_df: pd.DataFrame,
+                      value_col: str) -> Dict[Tuple[str, ...], pd.DataFrame]:
+    """
+    Returns a new cube that adds the rows of @new_df to @cube, a result of
+    build_stats_cube over the same @value_col. Only @new_df is scanned, the
+    statistics of its groups are merged with the ones already in @cube.
+    """
+    any_stats_df = next(iter(cube.values()))
+    bin_edges = np.asarray(any_stats_df.attrs["bin_edges"])
+    new_cube = build_stats_cube(new_df, value_col, list(cube), bin_edges)
+    merged_cube = {}
+    for dims, stats_df in cube.items():
+        merge_ops = {
+            col: ("min" if col == "min" else "max" if col == "max" else "sum")
+            for col in stats_df.columns
+        }
+        merged_df = (
+            pd.concat([stats_df, new_cube[dims]])
+                .groupby(level=list(range(len(dims))))
+                .agg(merge_ops)
+        )
+        merged_df.attrs["bin_edges"] = tuple(bin_edges)
+        merged_cube[dims] = merged_df
+    return merged_cube
+
+
+def cube_quantiles(stats_df: pd.DataFrame,
+                   quantiles: Sequence[float]) -> pd.DataFrame:
+    """
+    Approximates @quantiles of every group in @stats_df, an entry of a cube
+    given by build_stats_cube, interpolating linearly inside the histogram
+    bins. Results are clipped to the exact minimum and maximum of each group.
+    """
+    bin_edges = np.asarray(stats_df.attrs["bin_edges"])
+    histogram = stats_df.filter(regex=r"^bin_\d+$").to_numpy(dtype=np.float64)
+    cumulative = np.cumsum(histogram, axis=1)
+    counts = cumulative[:, -1:]
+    result = {}
+    for q in quantiles:
+        target = q * counts
+        bin_ids = np.minimum((cumulative < target).sum(axis=1),
+                             histogram.shape[1] - 1)
+        rows = np.arange(len(bin_ids))
+        before = np.where(bin_ids > 0, cumulative[rows, bin_ids - 1], 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.nan_to_num(
+                (target[:, 0] - before) / histogram[rows, bin_ids])
+        estimate = (bin_edges[bin_ids] + fraction *
+                    (bin_edges[bin_ids + 1] - bin_edges[bin_ids]))
+        result[f"{q:.0%}"] = np.clip(estimate, stats_df["min"].to_numpy(),
+                                     stats_df["max"].to_numpy())
+    return pd.DataFrame(result, index=stats_df.index)
+
+
+def describe_from_cube(stats_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns a table with the same statistics as DataFrame.describe for every
+    group of @stats_df, an entry of a cube given by build_stats_cube. Quartiles
+    are approximated by cube_quantiles.
+    """
+    count = stats_df["count"]
+    mean = stats_df["sum"] / count
+    variance = (stats_df["sum_sq"] - count * mean**2) / (count - 1)
+    return pd.concat([
+        pd.DataFrame({
+            "count": count,
+            "mean": mean,
+            "std": np.sqrt(variance.clip(lower=0)),
+            "min": stats_df["min"]
+        }),
+        cube_quantiles(stats_df, (0.25, 0.5, 0.75)),
+        stats_df[["max"]]
+    ], axis=1)
+
+
+def parse_dates(dates: pd.Series,
+                date_format: str = "%d/%m/%Y") -> pd.Series:
+    """
+    Converts the strings of @dates into datetimes using the explicit
+    @date_format, which avoids inferring the format element by element and the
+    ambiguity between days and months. Each distinct string is parsed only
+    once and the result is spread to the rest of the rows by its code.
+    """
+    codes, uniques = pd.factorize(dates)
+    parsed = pd.to_datetime(pd.Series(uniques), format=date_format)
+    # Null dates are coded as -1, which takes the trailing NaT.
+    parsed = np.append(parsed.to_numpy(), np.datetime64("NaT", "ns"))
+    return pd.Series(parsed[codes], index=dates.index, name=dates.name)
+
+
+def date_bucket_codes(dates: pd.Series, freq: str = "month") -> pd.Series:
+    """
+    Returns for each datetime of @dates an integer code of its time bucket:
+    months since January 1970 if @freq is "month", or weeks (starting on
+    Monday) since the first one of 1970 if @freq is "week". Null dates get -1.
+    """
+    values = dates.to_numpy(dtype="datetime64[ns]")
+    if freq == "month":
+        codes = values.astype("datetime64[M]").astype(np.int64)
+    elif freq == "week":
+        # January 1st of 1970 was a Thursday, so shift three days to Monday.
+        codes = (values.astype("datetime64[D]").astype(np.int64) + 3) // 7
+    else:
+        raise ValueError(f"Unknown frequency {freq}")
+    codes[np.isnat(values)] = -1
+    return pd.Series(codes, index=dates.index, name=f"{dates.name}_{freq}")
+
+
+def bucket_start(codes: np.ndarray, freq: str = "month") -> np.ndarray:
+    """
+    Inverse of date_bucket_codes. Returns the first day of the bucket of each
+    code in @codes.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    if freq == "month":
+        return codes.astype("datetime64[M]").astype("datetime64[ns]")
+    if freq == "week":
+        return (codes * 7 - 3).astype("datetime64[D]").astype("datetime64[ns]")
+    raise ValueError(f"Unknown frequency {freq}")
+
+
+def bucketed_series(df: pd.DataFrame,
+                    bucket_col: str,
+                    value_col: str,
+                    group_cols: List[str],
+                    quantiles: Sequence[float] = (0.25, 0.5, 0.75),
+                    freq: str = "month") -> pd.DataFrame:
+    """
+    Computes for every group of @group_cols and time bucket in @bucket_col, as
+    given by date_bucket_codes, the count, mean and exact @quantiles of
+    @value_col. Keys are factorized once and rows are sorted a single time by
+    group and value, so all the statistics come from one pass over the sorted
+    values. The resulting index has the start date of each bucket instead of
+    its code.
+    """
+    dims = tuple(group_cols) + (bucket_col,)
+    factorized = factorize_columns(df, list(dims))
+    keys, valid = combine_codes(factorized, dims)
+    values = df[value_col].to_numpy(dtype=np.float64)
+    valid &= ~np.isnan(values) & (df[bucket_col].to_numpy() >= 0)
+    keys, values = keys[valid], values[valid]
+
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    group_keys, starts, counts = np.unique(keys,
+                                           return_index=True,
+                                           return_counts=True)
+    series_df = pd.DataFrame({
+        "count": counts,
+        "mean": np.add.reduceat(values, starts) / counts
+    })
+    for q in quantiles:
+        position = starts + q * (counts - 1)
+        below = np.floor(position).astype(np.int64)
+        above = np.ceil(position).astype(np.int64)
+        series_df[f"{q:.0%}"] = values[below] + (position - below) * (
+            values[above] - values[below])
+
+    index = decode_codes(factorized, dims, group_keys).to_frame()
+    index[bucket_col] = bucket_start(index[bucket_col].to_numpy(), freq)
+    series_df.index = (pd.MultiIndex.from_frame(index) if len(dims) > 1 else
+                       pd.Index(index[bucket_col], name=bucket_col))
+    return series_df
+
+
+def append_filtered_batch(
+        housing_batch_df: pd.DataFrame, new_suburbs_df: pd.DataFrame,
+        state: Dict[str, Any]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Pushes only a new batch of sales through the filters, binnings and
+    imputations of this notebook. @housing_batch_df and @new_suburbs_df are the
+    partitions written by append_sales_batch in combine_airbnb_dataset, and
+    @state is the dictionary saved at the end of this notebook. Outlier bounds,
+    segment intervals, region segments and imputation values are taken from
+    @state instead of being computed from the batch. The filtered sales are
+    added to the price cube of @state with update_stats_cube, and the regions
+    of the new suburbs to its suburb regions, so @state must be saved again
+    to keep them. Returns the filtered housing and suburb rows.
+    """
+    housing_df, _ = clean_outliers(housing_batch_df, "housing_price",
+                                   state["price_bounds"])
+    housing_df = housing_df.assign(
+        housing_bathroom_count=housing_df["housing_bathroom_count"].clip(
+            lower=1))
+    housing_df = housing_df.assign(**{
+        segment_col: pd.cut(housing_df[count_col], intervals)
+        for segment_col, (count_col, intervals) in state["segments"].items()
+    })
+    housing_df = housing_df[
+        ~(housing_df["housing_building_area"] > state["max_building_area"]) &
+        ~(housing_df["housing_year_built"] < state["min_year_built"])]
+
+    suburb_df = new_suburbs_df.assign(
+        suburb_region_segment=new_suburbs_df["suburb_region_name"].replace(
+            state["region_segments"]),
+        suburb_rental_dailyprice=new_suburbs_df[
+            "suburb_rental_dailyprice"].fillna(
+                state["rental_dailyprice_mean"]))
+    missing_suburbs = (suburb_df["suburb_council_area"].isna() &
+                       suburb_df["suburb_name"].isin(state["new_councils"]))
+    suburb_df.loc[missing_suburbs, "suburb_council_area"] = (
+        suburb_df
+            .loc[missing_suburbs, "suburb_name"]
+            .apply(lambda suburb: [state["new_councils"][suburb]])
+    )
+
+    suburb_regions = pd.concat([state["suburb_regions"],
+                                suburb_df["suburb_region_name"]])
+    state["suburb_regions"] = suburb_regions[
+        ~suburb_regions.index.duplicated(keep="last")]
+    state["price_cube"] = update_stats_cube(
+        state["price_cube"],
+        housing_df.join(state["suburb_regions"], on="suburb_id"),
+        "housing_price")
+    return (housing_df[state["selected_housing_columns"]],
+            suburb_df[state["selected_suburb_columns"]])
 # %%
 URL_MELB_HOUSING_DATA = "https://www.famaf.unc.edu.ar/~nocampo043/melb_housing_df.csv"
 URL_MELB_SUBURB_DATA = "https://www.famaf.unc.edu.ar/~nocampo043/melb_suburb_df.csv"
 
-melb_housing_df = pd.read_csv(URL_MELB_HOUSING_DATA)
-melb_suburb_df = pd.read_csv(URL_MELB_SUBURB_DATA)
+remote_inputs = fetch_inputs(
+    {
+        "housing": {"url": URL_MELB_HOUSING_DATA},
+        "suburb": {"url": URL_MELB_SUBURB_DATA},
+        "region_boundaries": REGION_BOUNDARIES_INPUT,
+    }, {
+        "housing": partial(pd.read_csv, dtype=HOUSING_TEXT_DTYPES),
+        "suburb": pd.read_csv,
+        "region_boundaries": json.load,
+    })
+
+with track_stage("read_housing_csv") as stage:
+    melb_housing_df = remote_inputs["housing"].result().rename_axis("sale_id")
+    stage["shape_out"] = shape_of(melb_housing_df)
+with track_stage("read_suburb_csv") as stage:
+    melb_suburb_df = remote_inputs["suburb"].result()
+    stage["shape_out"] = shape_of(melb_suburb_df)
+data_version = "full"
+clear_column_statistics()
 # %%
 melb_suburb_df
 # %%
@@ -180,8 +709,9 @@ que solo es de interés conocer el precio de venta de aquellas viviendas
 comercializadas con mayor frecuencia.
 """
 # %%
+price_bounds = outlier_bounds(melb_housing_df["housing_price"], data_version)
 melb_housing_df, melb_housing_outliers_df = clean_outliers(
-    melb_housing_df, "housing_price")
+    melb_housing_df, "housing_price", price_bounds)
 # %%
 melb_housing_df
 # %%
@@ -313,7 +843,6 @@ melb_housing_df = melb_housing_df.assign(housing_garage_segment=to_categorical(
     max_cut=2))
 # %%
 melb_housing_df["housing_garage_segment"].unique()
-
 # %%
 plt.figure(figsize=(16, 8))
 seaborn.boxplot(x="housing_garage_segment",
@@ -351,15 +880,14 @@ Se considera que esta variable es importante para predecir el precio, por ende
 se procedió a imputar sus valores faltantes en una sección posterior.
 """
 # %%
-msno.bar(melb_housing_df[["housing_price", "housing_building_area"]],
-         figsize=(12, 6),
-         fontsize=12)
+plot_missingness_bar(
+    missingness_summary(
+        melb_housing_df[["housing_price", "housing_building_area"]]))
 # %%
 plt.figure(figsize=(16, 8))
 seaborn.boxplot(x="housing_building_area",
                 data=melb_housing_df)
 plt.ticklabel_format(style="plain", axis="x")
-
 # %% [markdown]
 """
 Se puede observar la presencia de un valor extremo de 44515. Se decidió eliminar
@@ -376,6 +904,33 @@ melb_housing_df = melb_housing_df.drop(big_area.index)
 melb_housing_df[[ "housing_building_area"]].describe()
 # %% [markdown]
 """
+Para analizar el precio de venta según las variables categóricas se construyó un
+cubo de estadísticas de `housing_price`. Cada dimensión se factoriza una única
+vez y, para cada combinación de dimensiones, se calculan en una sola pasada la
+cantidad de ventas, la suma, la suma de cuadrados, el mínimo, el máximo y un
+histograma que permite aproximar cuantiles. De esta forma, los resúmenes de las
+secciones siguientes se leen del cubo sin volver a recorrer las ventas, y si se
+agregan nuevas ventas basta con combinarlas por medio de `update_stats_cube`.
+
+A diferencia de `describe`, los cuartiles (25%, 50% y 75%) de las tablas
+obtenidas con `describe_from_cube` son aproximados: se interpolan dentro de los
+256 intervalos logarítmicos del histograma, por lo que pueden diferir levemente
+de los valores exactos. La cantidad, la media, el desvío, el mínimo y el máximo
+son exactos.
+"""
+# %%
+price_cube_dimensions = [("housing_type",),
+                         ("housing_selling_method",),
+                         ("housing_seller_agency",),
+                         ("suburb_region_name",),
+                         ("housing_type", "housing_selling_method")]
+price_cube = build_stats_cube(
+    melb_housing_df.join(melb_suburb_df["suburb_region_name"],
+                         on="suburb_id"),
+    "housing_price",
+    price_cube_dimensions)
+# %% [markdown]
+"""
 ### Tipo de vivienda (`housing_type`)
 Significado de cada categoría:
 
@@ -386,12 +941,7 @@ Significado de cada categoría:
 - `t`: Casa adosada.
 """
 # %%
-(
-    melb_housing_df[["housing_type", "housing_price"]]
-        .groupby("housing_type")
-        .describe()
-        .round(2)
-)
+describe_from_cube(price_cube[("housing_type",)]).round(2)
 # %%
 plt.figure(figsize=(8,8))
 seaborn.boxenplot(data=melb_housing_df, x="housing_price", y="housing_type")
@@ -427,12 +977,7 @@ Significado de cada método:
 - `VB` - Oferta del proveedor.
 """
 # %%
-(
-    melb_housing_df[["housing_selling_method", "housing_price"]]
-        .groupby("housing_selling_method")
-        .describe()
-        .round(2)
-)
+describe_from_cube(price_cube[("housing_selling_method",)]).round(2)
 # %%
 plt.figure(figsize=(8,8))
 seaborn.boxenplot(data=melb_housing_df,
@@ -440,13 +985,13 @@ seaborn.boxenplot(data=melb_housing_df,
                   y="housing_selling_method")
 plt.ticklabel_format(style="plain", axis="x")
 # %%
-types = melb_housing_df["housing_type"].unique()
+describe_from_cube(
+    price_cube[("housing_type", "housing_selling_method")]).round(2)
+# %%
 fig, axes = plt.subplots(3, figsize=(12,12))
 
-for ax, type in zip(axes, types):
-    houses_by_type_df = melb_housing_df[
-        melb_housing_df["housing_type"] == type
-    ]
+for ax, (_, houses_by_type_df) in zip(
+        axes, melb_housing_df.groupby("housing_type", sort=False)):
     seaborn.boxenplot(ax=ax,
                       data=houses_by_type_df,
                       x="housing_price",
@@ -478,11 +1023,10 @@ ellos.
 """
 # %%
 best_sellers_df = (
-    melb_housing_df[["housing_seller_agency", "housing_price"]]
-        .groupby("housing_seller_agency")
-        .agg(sales_count=("housing_seller_agency", "count"),
-             sales_percentage=("housing_seller_agency",
-                                lambda sales: 100 * len(sales) / len(melb_housing_df)))
+    price_cube[("housing_seller_agency",)][["count"]]
+        .rename(columns={"count": "sales_count"})
+        .assign(sales_percentage=lambda sellers_df:
+                100 * sellers_df["sales_count"] / len(melb_housing_df))
         .sort_values(by="sales_count", ascending=False)
         .head(20)
 )
@@ -495,6 +1039,7 @@ seaborn.barplot(
         best_sellers_df.index)],
     x="housing_seller_agency",
     y="housing_price",
+    order=best_sellers_df.index,
     estimator=np.mean)
 plt.xlabel("Agencia de ventas")
 plt.ylabel("Precio promedio de ventas")
@@ -507,7 +1052,10 @@ más altos que otros, por ejemplo el vendedor `Marshall` sobresale por el resto
 con un precio medio de venta de 1,5 millones. Sin embargo, no se puede asegurar
 que el mayor precio de la venta sea por una mejor gestión del vendedor y no por
 otro tipo de variable, como ser el tipo de casa, la ubicación o bien su tamaño o
-composición. Por lo tanto, tampoco se decidió seleccionarla.
+composición. Por lo tanto, tampoco se decidió seleccionarla como variable
+categórica. No obstante, se conserva en el conjunto filtrado para que
+`encode_dataset.ipynb` la reemplace por una única columna con el precio medio
+de venta de cada agencia (*target encoding*).
 """
 # %% [markdown]
 """
@@ -540,12 +1088,7 @@ registró una mayor cantidad de ventas de viviendas (4377) a diferencia de
 de 100.
 """
 # %%
-(
-    melb_housing_df
-        .join(melb_suburb_df, on="suburb_id")
-        .loc[:, "suburb_region_name"]
-        .value_counts()
-)
+price_cube[("suburb_region_name",)]["count"].sort_values(ascending=False)
 # %% [markdown]
 """
 #### Geolocalización de propiedades por región
@@ -558,26 +1101,15 @@ src="https://github.com/benjaminocampo/DataCuration/blob/master/notebooks/graphs
 alt="melbourne by region">
 
 Se utilizó el servicio de [wfs de geoserver](https://data.gov.au/geoserver)
-donde se obtiene una representación geométrica de las regiones.
+donde se obtiene una representación geométrica de las regiones. La consulta,
+descrita en `REGION_BOUNDARIES_INPUT`, se descargó al comienzo de la notebook
+junto con los archivos `.csv`.
 """
 # %%
-geoserver = "https://data.gov.au/geoserver"
-route = "vic-state-electoral-boundaries-psma-administrative-boundaries"
-service = "wfs"
-projection = "EPSG:3110"
-
-wfsurl = f"{geoserver}/{route}/{service}"
-
-params = dict(service="WFS",
-              version="2.0.0",
-              request="GetFeature",
-              typeName=(route + ":ckan_a0d8838b_2423_4c8b_a7d9_b04eb240a2b1"),
-              outputFormat="json")
-
-features = requests.get(wfsurl, params=params).json()
+features = remote_inputs["region_boundaries"].result()
 
 region_location_df = gpd.GeoDataFrame.from_features(features).set_crs(
-    projection)
+    REGION_BOUNDARIES_PROJECTION)
 
 region_location_df.head()
 # %% [markdown]
@@ -649,6 +1181,19 @@ plot_melbourne_map(locations_df.join(melb_housing_df["housing_price"]),
                    metropolitan_regions, "housing_price")
 # %% [markdown]
 """
+Dibujar un marcador por venta hace que el tiempo de graficado y la memoria
+crezcan linealmente con la cantidad de filas. Para conjuntos de datos más
+grandes se puede utilizar `plot_melbourne_raster`, que agrupa las ventas en una
+grilla de celdas por medio de `np.bincount` y dibuja la imagen resultante sobre
+las regiones. En este caso, cada celda muestra el precio promedio de las ventas
+que caen en ella, por lo que el costo de graficar depende de la cantidad de
+celdas y no de la cantidad de ventas.
+"""
+# %%
+plot_melbourne_raster(melb_housing_df, metropolitan_regions, "housing_price",
+                      statistic="mean", resolution=200)
+# %% [markdown]
+"""
 Estas observaciones dejan en evidencia que la localización de las viviendas
 puede influir en el precio de las mismas. En este sentido, se decide incluir la
 variable `suburb_region_name` en futuros análisis. Respecto a la variable
@@ -673,13 +1218,14 @@ agruparlos bajo una misma categoría, denominada `Victoria`.
         .size()
 )
 # %%
+region_segments = {
+    "Western Victoria": "Victoria",
+    "Eastern Victoria": "Victoria",
+    "Northern Victoria": "Victoria"
+}
 melb_suburb_df = melb_suburb_df.assign(
     suburb_region_segment=melb_suburb_df["suburb_region_name"].replace(
-        {
-            "Western Victoria": "Victoria",
-            "Eastern Victoria": "Victoria",
-            "Northern Victoria": "Victoria"
-        }))
+        region_segments))
 # %%
 (
     melb_housing_df
@@ -742,11 +1288,15 @@ variables como inflación o burbujas inmobiliarias durante el período de venta.
 Dado que el conjunto de datos corresponden a ventas efectuadas durante los años
 2016 y 2017, es importante saber como fluctuó el precio durante este intervalo.
 Por ende, se trabajó sobre esta variable convirtiendo inicialmente los datos en
-objetos `datetime`.
+objetos `datetime`. Las fechas se encuentran en el formato `día/mes/año`, por lo
+que se indicó de manera explícita a través de `parse_dates`. Esto evita que
+`pandas` infiera el formato elemento a elemento, interpretando de manera ambigua
+el orden entre días y meses, y permite convertir una única vez cada fecha
+distinta.
 """
 # %%
 melb_housing_df = melb_housing_df.assign(
-    housing_date_sold_datetime=pd.to_datetime(
+    housing_date_sold_datetime=parse_dates(
         melb_housing_df["housing_date_sold"]))
 melb_housing_df["housing_date_sold_datetime"]
 # %%
@@ -763,14 +1313,29 @@ obtiene probablemente a que se están considerando no solo los años y meses, si
 también el día de la venta, siendo esto quizás no tan relevante si se desea
 identificar un período donde se realizaron ventas de un alto valor.
 """
+# %% [markdown]
+"""
+Para agrupar las ventas por mes, en lugar de convertir las fechas a texto y
+nuevamente a `datetime`, se obtiene para cada una un código entero de su mes
+por medio de `date_bucket_codes`. Luego, `bucketed_series` calcula en una sola
+pasada la cantidad de ventas, la media y los cuantiles del precio por mes.
+"""
 # %%
 melb_housing_df = melb_housing_df.assign(
-    housing_date_sold_datetime=pd.to_datetime(
-        melb_housing_df["housing_date_sold_datetime"].dt.strftime("%Y-%m")))
-
-seaborn.lineplot(data=melb_housing_df,
-                 x="housing_date_sold_datetime",
-                 y="housing_price")
+    housing_date_sold_month=date_bucket_codes(
+        melb_housing_df["housing_date_sold_datetime"], "month"))
+monthly_prices_df = bucketed_series(melb_housing_df,
+                                    "housing_date_sold_month",
+                                    "housing_price",
+                                    group_cols=[])
+monthly_prices_df
+# %%
+plt.figure(figsize=(10, 5))
+plt.plot(monthly_prices_df.index, monthly_prices_df["50%"])
+plt.fill_between(monthly_prices_df.index,
+                 monthly_prices_df["25%"],
+                 monthly_prices_df["75%"],
+                 alpha=0.3)
 plt.ticklabel_format(style="plain", axis="y")
 plt.xticks(rotation=45)
 # %% [markdown]
@@ -780,15 +1345,10 @@ variabilidad pero aún así no se perciben una tendencia clara en las
 fluctuaciones del precio.
 """
 # %%
-melb_housing_df = melb_housing_df.assign(
-    housing_date_sold_datetime=melb_housing_df["housing_date_sold_datetime"].
-    dt.strftime("%Y-%m"))
-
 plt.figure(figsize=(10, 10))
-seaborn.barplot(data=melb_housing_df,
-                x="housing_date_sold_datetime",
-                y="housing_price",
-                estimator=np.mean)
+seaborn.barplot(x=monthly_prices_df.index.strftime("%Y-%m"),
+                y=monthly_prices_df["mean"],
+                color="steelblue")
 plt.xticks(rotation=45)
 # %% [markdown]
 """
@@ -799,6 +1359,28 @@ de venta de las propiedades.
 """
 # %% [markdown]
 """
+Las mismas series pueden obtenerse por región y tipo de vivienda agregando
+columnas de agrupación a `bucketed_series`.
+"""
+# %%
+monthly_prices_by_group_df = bucketed_series(
+    melb_housing_df.join(melb_suburb_df["suburb_region_segment"],
+                         on="suburb_id"),
+    "housing_date_sold_month",
+    "housing_price",
+    group_cols=["suburb_region_segment", "housing_type"])
+monthly_prices_by_group_df
+# %%
+plt.figure(figsize=(12, 6))
+seaborn.lineplot(data=monthly_prices_by_group_df.reset_index(),
+                 x="housing_date_sold_month",
+                 y="50%",
+                 hue="housing_type")
+plt.ylabel("Mediana del precio de venta")
+plt.ticklabel_format(style="plain", axis="y")
+plt.xticks(rotation=45)
+# %% [markdown]
+"""
 ### Año de construcción (`housing_year_built`)
 """
 # %%
@@ -905,7 +1487,7 @@ melb_suburb_df[missing_suburbs]
 ### Columnas del dataset de AirBnB (`suburb_rental_dailyprice`)
 """
 # %%
-msno.bar(melb_suburb_df, figsize=(12, 6), fontsize=12, color='steelblue')
+plot_missingness_bar(missingness_summary(melb_suburb_df))
 # %%
 melb_suburb_df["suburb_rental_dailyprice"].isna().sum()
 # %% [markdown]
@@ -927,13 +1509,15 @@ encuentran en valores cercanos), por lo cual se imputó esta variable por su
 valor medio.
 """
 # %%
+rental_dailyprice_mean = column_statistics(
+    melb_suburb_df["suburb_rental_dailyprice"], data_version,
+    ("mean",))["mean"]
 melb_suburb_df["suburb_rental_dailyprice"] = (
-    melb_suburb_df["suburb_rental_dailyprice"]
-        .fillna(melb_suburb_df["suburb_rental_dailyprice"].mean())
+    melb_suburb_df["suburb_rental_dailyprice"].fillna(rental_dailyprice_mean)
 )
 melb_suburb_df.suburb_rental_dailyprice.isna().sum()
 # %%
-msno.bar(melb_suburb_df, figsize=(12, 6), fontsize=12, color='steelblue')
+plot_missingness_bar(missingness_summary(melb_suburb_df))
 # %% [markdown]
 """
 Se observa que ya no existen valores faltantes en la columna
@@ -944,7 +1528,9 @@ imputación del tipo KNN nos podría dar mayor información sobre esta variable.
 """
 ### Creación del conjunto de datos
 A continuación, se procedió a remover las columnas no seleccionadas de
-`melb_suburb_df` y `melb_housing_df` y guardarlos en archivos `.csv`
+`melb_suburb_df` y `melb_housing_df` y guardarlos en archivos `.csv`. Las ventas
+se guardan con su índice `sale_id`, y `encode_dataset.ipynb` lee ambos archivos
+desde este directorio.
 """
 # %%
 selected_housing_columns = [
@@ -955,6 +1541,7 @@ selected_housing_columns = [
     "housing_building_area",
     "housing_type",
     "housing_year_built",
+    "housing_seller_agency",
     "suburb_id"
 ]
 selected_suburb_columns = [
@@ -968,6 +1555,88 @@ melb_housing_filtered_df = melb_housing_df[selected_housing_columns]
 
 melb_suburb_filtered_df = melb_suburb_df[selected_suburb_columns]
 # %%
-melb_housing_filtered_df.to_csv("melb_housing_filtered_df.csv", index=False)
+melb_housing_filtered_df.to_csv("melb_housing_filtered_df.csv")
 melb_suburb_filtered_df.to_csv("melb_suburb_filtered_df.csv", index=False)
+# %% [markdown]
+"""
+### Modo incremental
+Para procesar nuevos lotes de ventas sin repetir la exploración, se guardan los
+parámetros obtenidos en las secciones anteriores: los límites de *outliers* del
+precio, los intervalos de los segmentos, la agrupación de regiones, los
+departamentos gubernamentales buscados externamente, y el precio de renta medio
+utilizado en la imputación. También se guarda el cubo de estadísticas del
+precio, construido nuevamente sobre las ventas que quedaron luego de todos los
+filtros, junto con la región de cada suburbio. Así, los lotes nuevos se agregan
+al cubo sin recorrer las ventas anteriores, y los resúmenes por categoría se
+leen del estado guardado.
+"""
+# %%
+EXPLORATION_STATE_PATH = "melbourne_exploration_state.pkl"
+suburb_regions = melb_suburb_df["suburb_region_name"]
+
+with open(EXPLORATION_STATE_PATH, "wb") as state_file:
+    pickle.dump(
+        {
+            "price_bounds": price_bounds,
+            "segments": {
+                segment_col: (count_col,
+                              melb_housing_df[segment_col].cat.categories)
+                for segment_col, count_col in [
+                    ("housing_room_segment", "housing_room_count"),
+                    ("housing_bathroom_segment", "housing_bathroom_count")
+                ]
+            },
+            "max_building_area": 10000,
+            "min_year_built": 1800,
+            "region_segments": region_segments,
+            "new_councils": new_councils,
+            "rental_dailyprice_mean": rental_dailyprice_mean,
+            "suburb_regions": suburb_regions,
+            "price_cube": build_stats_cube(
+                melb_housing_df.join(suburb_regions, on="suburb_id"),
+                "housing_price",
+                price_cube_dimensions),
+            "selected_housing_columns": selected_housing_columns,
+            "selected_suburb_columns": selected_suburb_columns,
+        }, state_file)
+# %% [markdown]
+"""
+Las particiones escritas por el modo incremental de
+`combine_airbnb_dataset.ipynb` se procesan por medio de `append_filtered_batch`
+y se escriben como nuevas particiones de los conjuntos filtrados. El lote
+también se agrega al cubo de precios del estado, cuyos resúmenes se muestran a
+continuación sin volver a leer las ventas. Para incorporar un lote real,
+`exploration_state` debe volver a escribirse en `EXPLORATION_STATE_PATH` luego
+de escribir sus particiones. Las rutas de
+todas las particiones se definen en `pipeline_helpers.py`, por lo que no
+dependen del directorio desde el que se ejecute cada *notebook*.
+"""
+# %%
+batch_id = "example"
+housing_batch_df = pd.read_csv(
+    partition_path(MELB_HOUSING_PARTITIONS, batch_id),
+    index_col=0, dtype=HOUSING_TEXT_DTYPES)
+new_suburbs_df = pd.read_csv(partition_path(MELB_SUBURB_PARTITIONS, batch_id),
+                             index_col=0)
+
+with open(EXPLORATION_STATE_PATH, "rb") as state_file:
+    exploration_state = pickle.load(state_file)
+
+housing_filtered_batch_df, suburb_filtered_batch_df = append_filtered_batch(
+    housing_batch_df, new_suburbs_df, exploration_state)
+write_partition(housing_filtered_batch_df, MELB_HOUSING_FILTERED_PARTITIONS,
+                batch_id)
+write_partition(suburb_filtered_batch_df, MELB_SUBURB_FILTERED_PARTITIONS,
+                batch_id)
+housing_filtered_batch_df
+# %%
+describe_from_cube(exploration_state["price_cube"][("housing_type",)]).round(2)
+# %% [markdown]
+"""
+### Instrumentación
+Por último, se guarda el reporte de tiempos y memoria de las etapas registradas
+por `track_stage` durante la exploración.
+"""
+# %%
+print(write_stage_report("melbourne_exploration_stages"))
 # %%
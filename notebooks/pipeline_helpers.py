@@ -0,0 +1,766 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the notebooks of the preprocessing pipeline
+(melbourne_exploration.py, combine_airbnb_dataset.py and encode_dataset.py).
+
+It groups the stage instrumentation, the concurrent download of the remote
+inputs, the missing value summaries, the cached column statistics and the
+writers of batch partitions and feature groups, so every notebook uses the
+same implementation. The notebooks import it after adding this directory to
+sys.path.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+import requests
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from matplotlib.colors import ListedColormap
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+TRACK_MEMORY = os.environ.get("TRACK_MEMORY", "") not in ("", "0")
+STAGE_RECORDS: List[Dict[str, Any]] = []
+_STAGE_STACK: List[Dict[str, Any]] = []
+
+
+def shape_of(data: Any) -> Optional[List[int]]:
+    """
+    Returns the shape of @data as a list if it has one (dataframes, series,
+    arrays and sparse matrices), otherwise None.
+    """
+    shape = getattr(data, "shape", None)
+    return None if shape is None else [int(size) for size in shape]
+
+
+def peak_rss_mb() -> Optional[float]:
+    """
+    Returns the peak resident set size of the process in megabytes, or None if
+    the platform does not provide it.
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextmanager
+def track_stage(name: str, data_in: Any = None) -> Iterator[Dict[str, Any]]:
+    """
+    Measures the wall time, CPU time and peak RSS of the block it wraps, and
+    appends them to STAGE_RECORDS as a stage called @name. Stages can be
+    nested, in which case their names are joined by "/". The shape of
+    @data_in is recorded as input, and the yielded record can be updated with
+    the "shape_out" of the block result. The tracemalloc peak is measured too
+    only if TRACK_MEMORY is set (by the TRACK_MEMORY environment variable or
+    by assigning it), since tracing every allocation slows down the stages it
+    measures. Tracing is then started by the outermost stage and stopped when
+    it exits, unless it was already running.
+    """
+    owns_tracing = (TRACK_MEMORY and not _STAGE_STACK and
+                    not tracemalloc.is_tracing())
+    if owns_tracing:
+        tracemalloc.start()
+    tracing = tracemalloc.is_tracing()
+    if tracing and _STAGE_STACK:
+        parent = _STAGE_STACK[-1]
+        parent["_peak"] = max(parent["_peak"],
+                              tracemalloc.get_traced_memory()[1])
+    if tracing and hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+
+    record = {
+        "stage": "/".join([r["name"] for r in _STAGE_STACK] + [name]),
+        "name": name,
+        "depth": len(_STAGE_STACK),
+        "shape_in": shape_of(data_in),
+        "shape_out": None,
+        "_peak": 0,
+    }
+    rss_start = peak_rss_mb()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    _STAGE_STACK.append(record)
+    try:
+        yield record
+    finally:
+        _STAGE_STACK.pop()
+        peak = record.pop("_peak")
+        if tracing and tracemalloc.is_tracing():
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+        if owns_tracing:
+            tracemalloc.stop()
+        rss_end = peak_rss_mb()
+        record.update(
+            start=wall_start,
+            wall_time=time.perf_counter() - wall_start,
+            cpu_time=time.process_time() - cpu_start,
+            peak_rss_mb=rss_end,
+            peak_rss_growth_mb=(None if rss_end is None else rss_end -
+                                rss_start),
+            tracemalloc_peak_mb=peak / 2**20 if tracing else None)
+        if _STAGE_STACK:
+            parent = _STAGE_STACK[-1]
+            parent["_peak"] = max(parent["_peak"], peak)
+        STAGE_RECORDS.append(record)
+
+
+def tracked(function: Callable) -> Callable:
+    """
+    Decorator that runs @function inside track_stage, using its name as stage
+    name, its first argument with a shape as input and its result as output.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        data_in = next((arg for arg in args if hasattr(arg, "shape")), None)
+        with track_stage(function.__name__, data_in) as stage:
+            result = function(*args, **kwargs)
+            stage["shape_out"] = shape_of(result)
+        return result
+
+    return wrapper
+
+
+def write_stage_report(path_prefix: str) -> str:
+    """
+    Writes the stages in STAGE_RECORDS as JSON in @path_prefix.json, and a
+    flame-style summary where nested stages are indented under their parents
+    and bars are proportional to wall time in @path_prefix.txt. Returns the
+    summary.
+    """
+    records = sorted(STAGE_RECORDS, key=lambda r: (r["start"], r["depth"]))
+    with open(f"{path_prefix}.json", "w") as report_file:
+        json.dump(records, report_file, indent=2)
+
+    total_time = sum(r["wall_time"] for r in records if r["depth"] == 0)
+    lines = []
+    for r in records:
+        bar = "#" * int(round(40 * r["wall_time"] / max(total_time, 1e-9)))
+        peak_mb = r["tracemalloc_peak_mb"]
+        peak_mb = float("nan") if peak_mb is None else peak_mb
+        lines.append(f"{'  ' * r['depth'] + r['name']:<45}"
+                     f"{r['wall_time']:9.2f}s wall"
+                     f"{r['cpu_time']:9.2f}s cpu"
+                     f"{peak_mb:9.1f}MB peak "
+                     f"{str(r['shape_in']):>14} -> {str(r['shape_out']):<14}"
+                     f" {bar}")
+    summary = "\n".join(lines)
+    with open(f"{path_prefix}.txt", "w") as summary_file:
+        summary_file.write(summary + "\n")
+    return summary
+
+
+FETCH_DIR = "remote_inputs"
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def input_path(spec: Dict[str, Any], fetch_dir: str = FETCH_DIR) -> str:
+    """
+    Returns the local path where the remote input described by @spec is
+    downloaded: its "filename" if given, otherwise the file name of its "url".
+    """
+    name = spec.get("filename") or os.path.basename(urlsplit(spec["url"]).path)
+    return os.path.join(fetch_dir, name)
+
+
+def fetch_session(pool_size: int = 8) -> requests.Session:
+    """
+    Returns a requests session that keeps up to @pool_size open connections
+    per host, so concurrent downloads from the same server reuse them.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Returns the hexadecimal sha256 of the file in @path.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as input_file:
+        for block in iter(lambda: input_file.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_fetched(spec: Dict[str, Any], path: str) -> bool:
+    """
+    Returns whether @path holds a complete download of @spec: its sha256 must
+    match the one recorded next to it when it was downloaded and, if given,
+    the "sha256" of @spec.
+    """
+    if not os.path.exists(path) or not os.path.exists(path + ".sha256"):
+        return False
+    with open(path + ".sha256") as checksum_file:
+        recorded = checksum_file.read().strip()
+    expected = spec.get("sha256", recorded)
+    return recorded == expected and file_sha256(path) == expected
+
+
+def download_input(session: requests.Session,
+                   spec: Dict[str, Any],
+                   path: str,
+                   sink: Optional[Any] = None,
+                   retries: int = 4,
+                   backoff: float = 0.5,
+                   chunk_size: int = 1 << 20,
+                   timeout: float = 30) -> str:
+    """
+    Downloads the "url" of @spec (with its "params", if any) into @path and
+    returns its sha256. The bytes are written to a ".part" file first and, if
+    one is left by an interrupted download, it is resumed with an HTTP range
+    request. Connection errors and responses with a status in
+    RETRY_STATUS_CODES are retried up to @retries times after waiting
+    @backoff * 2**attempt seconds, resuming from the bytes already written.
+    Every byte is also written in order, exactly once, to @sink, a binary file,
+    even if the server ignores the range and sends the file again. The file is
+    moved to @path only if its size matches the Content-Length and its sha256
+    the "sha256" of @spec, if given.
+    """
+    part_path = path + ".part"
+    digest = hashlib.sha256()
+    written = sent = 0
+
+    def deliver(block: bytes) -> None:
+        nonlocal sink, sent
+        view = memoryview(block)[len(block) - (written - sent):]
+        sent = written
+        try:
+            while sink is not None and view:
+                view = view[sink.write(view):]
+        except BrokenPipeError:
+            # The parser stopped reading, the file is still downloaded.
+            sink = None
+
+    if os.path.exists(part_path):
+        with open(part_path, "rb") as part:
+            for block in iter(lambda: part.read(chunk_size), b""):
+                digest.update(block)
+                written += len(block)
+                deliver(block)
+
+    for attempt in range(retries + 1):
+        headers = {"Accept-Encoding": "identity"}
+        if written:
+            headers["Range"] = f"bytes={written}-"
+        try:
+            with session.get(spec["url"],
+                             params=spec.get("params"),
+                             headers=headers,
+                             stream=True,
+                             timeout=timeout) as response:
+                if response.status_code == 416 and written:
+                    # The part file already holds the whole content.
+                    break
+                response.raise_for_status()
+                if written and response.status_code != 206:
+                    digest, written = hashlib.sha256(), 0
+                length = response.headers.get("Content-Length")
+                total = None if length is None else written + int(length)
+                with open(part_path, "ab" if written else "wb") as part:
+                    for block in response.iter_content(chunk_size):
+                        part.write(block)
+                        digest.update(block)
+                        written += len(block)
+                        if written > sent:
+                            deliver(block)
+            if total is not None and written != total:
+                raise requests.ConnectionError(
+                    f"Received {written} of {total} bytes")
+            break
+        except requests.RequestException as error:
+            status = getattr(error.response, "status_code", None)
+            if attempt == retries or (status is not None and
+                                      status not in RETRY_STATUS_CODES):
+                raise
+            time.sleep(backoff * 2**attempt)
+
+    checksum = digest.hexdigest()
+    if spec.get("sha256", checksum) != checksum:
+        os.remove(part_path)
+        raise ValueError(f"Checksum mismatch for {spec['url']}: expected "
+                         f"{spec['sha256']}, got {checksum}")
+    os.replace(part_path, path)
+    with open(path + ".sha256", "w") as checksum_file:
+        checksum_file.write(checksum)
+    return checksum
+
+
+def fetch_input(session: requests.Session,
+                spec: Dict[str, Any],
+                parser: Optional[Callable[[Any], Any]] = None,
+                fetch_dir: str = FETCH_DIR) -> Any:
+    """
+    Returns the remote input described by @spec parsed by @parser, a function
+    that receives a binary file (e.g. pd.read_csv or json.load), or its local
+    path if no parser is given. A previous complete download in @fetch_dir is
+    reused. Otherwise the file is downloaded by download_input on another
+    thread that streams it to @parser through a pipe, so parsing proceeds while
+    the file is being received.
+    """
+    path = input_path(spec, fetch_dir)
+    if not is_fetched(spec, path):
+        os.makedirs(fetch_dir, exist_ok=True)
+        if parser is None:
+            download_input(session, spec, path)
+        else:
+            read_fd, write_fd = os.pipe()
+            errors = []
+
+            def download() -> None:
+                with open(write_fd, "wb", buffering=0) as sink:
+                    try:
+                        download_input(session, spec, path, sink=sink)
+                    except Exception as error:
+                        errors.append(error)
+
+            writer = threading.Thread(target=download, daemon=True)
+            writer.start()
+            try:
+                with open(read_fd, "rb") as source:
+                    parsed = parser(source)
+            except Exception:
+                writer.join()
+                if errors:
+                    raise errors[0]
+                raise
+            writer.join()
+            if errors:
+                raise errors[0]
+            return parsed
+    if parser is None:
+        return path
+    with open(path, "rb") as source:
+        return parser(source)
+
+
+def fetch_inputs(inputs: Dict[str, Dict[str, Any]],
+                 parsers: Optional[Dict[str, Callable[[Any], Any]]] = None,
+                 fetch_dir: str = FETCH_DIR,
+                 max_workers: Optional[int] = None) -> Dict[str, Future]:
+    """
+    Starts fetching every input in @inputs at once, each one a mapping with
+    its "url" and optionally "params", "filename" and "sha256", and returns a
+    future per input name. Each future resolves to the result of fetch_input
+    with the parser of the same name in @parsers, so the total time is the one
+    of the slowest input instead of the sum of all of them. Downloads share a
+    session whose connection pool is sized for @max_workers threads, one per
+    input if not given. Any URL works, including a local http.server.
+    """
+    parsers = parsers or {}
+    max_workers = max_workers or len(inputs)
+    session = fetch_session(max_workers)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {
+        name: executor.submit(fetch_input, session, spec, parsers.get(name),
+                              fetch_dir) for name, spec in inputs.items()
+    }
+    executor.shutdown(wait=False)
+    return futures
+
+
+POPCOUNT_TABLE = np.array([bin(byte).count("1") for byte in range(256)],
+                          dtype=np.uint8)
+
+
+def popcount(bits: np.array, axis: int = -1) -> np.array:
+    """
+    Returns the number of set bits of the uint8 array @bits along @axis.
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(bits).sum(axis=axis, dtype=np.int64)
+    return POPCOUNT_TABLE[bits].sum(axis=axis, dtype=np.int64)
+
+
+def missingness_summary(df: pd.DataFrame,
+                        top_n: int = 10,
+                        chunk_size: int = 1 << 20) -> Dict[str, Any]:
+    """
+    Scans @df once, in chunks of @chunk_size rows, and returns the aggregates
+    needed to inspect its missing values: the number of rows, the null count
+    of every column, the number of rows where each pair of columns is null at
+    once and the @top_n most frequent missingness patterns (which columns are
+    null in a row) with their counts. The null masks of every chunk are packed
+    in bitsets, one per column, and counts are popcounts of their
+    intersections, so the cost depends on the number of rows / 8.
+    """
+    columns = list(df.columns)
+    nof_cols = len(columns)
+    co_missing = np.zeros((nof_cols, nof_cols), dtype=np.int64)
+    pattern_counts = []
+    for start in range(0, len(df), chunk_size):
+        mask = df.iloc[start:start + chunk_size].isna().to_numpy()
+        column_bits = np.packbits(mask, axis=0).T
+        for col in range(nof_cols):
+            co_missing[col] += popcount(column_bits[col] & column_bits)
+
+        row_bits = np.packbits(mask, axis=1)
+        width = row_bits.shape[1]
+        if width <= 8:
+            keys = np.pad(row_bits, ((0, 0), (0, 8 - width))).view(">u8")
+        else:
+            keys = np.ascontiguousarray(row_bits).view(
+                np.dtype((np.void, width)))
+        keys, counts = np.unique(keys.ravel(), return_counts=True)
+        pattern_counts.append(pd.Series(counts, index=keys.astype(object)))
+
+    patterns = (pd.concat(pattern_counts).groupby(level=0).sum()
+                if pattern_counts else pd.Series(dtype=np.int64))
+    patterns = patterns.sort_values(ascending=False, kind="stable").head(top_n)
+    if nof_cols <= 64:
+        pattern_bytes = np.array(patterns.index, dtype=">u8").view(
+            np.uint8).reshape(-1, 8)
+    else:
+        pattern_bytes = np.frombuffer(b"".join(patterns.index),
+                                      dtype=np.uint8).reshape(len(patterns), -1)
+    pattern_masks = np.unpackbits(pattern_bytes, axis=1)[:, :nof_cols]
+    return {
+        "columns": columns,
+        "nof_rows": len(df),
+        "null_counts": np.diag(co_missing).copy(),
+        "co_missing": co_missing,
+        "patterns": pattern_masks.astype(bool),
+        "pattern_counts": patterns.to_numpy(),
+    }
+
+
+def nullity_correlation(summary: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Returns the correlation between the null masks of every pair of columns of
+    @summary, computed from their null and co-missing counts. Columns without
+    missing values, or with only missing values, have NaN correlations.
+    """
+    nof_rows = summary["nof_rows"]
+    null_counts = summary["null_counts"].astype(float)
+    spread = np.sqrt(null_counts * (nof_rows - null_counts))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        correlation = ((nof_rows * summary["co_missing"] -
+                        np.outer(null_counts, null_counts)) /
+                       np.outer(spread, spread))
+    return pd.DataFrame(correlation,
+                        index=summary["columns"],
+                        columns=summary["columns"])
+
+
+def plot_missingness_bar(summary: Dict[str, Any],
+                         figsize: Tuple[int, int] = (12, 6),
+                         fontsize: int = 12,
+                         color: Any = "steelblue") -> plt.Axes:
+    """
+    Plots, like msno.bar, the fraction of non-null values of every column of
+    @summary, annotated with their count.
+    """
+    nof_rows = summary["nof_rows"]
+    non_null = nof_rows - summary["null_counts"]
+    fig, ax = plt.subplots(figsize=figsize)
+    ax.bar(range(len(non_null)), non_null / max(nof_rows, 1), color=color)
+    for position, count in enumerate(non_null):
+        ax.text(position, 1.01, str(count), ha="center", rotation=45,
+                fontsize=fontsize - 2)
+    ax.set_xticks(range(len(non_null)))
+    ax.set_xticklabels(summary["columns"], rotation=45, ha="right",
+                       fontsize=fontsize)
+    ax.set_ylim(0, 1.1)
+    ax.set_ylabel("Fracción de valores no nulos", fontsize=fontsize)
+    return ax
+
+
+def plot_missingness_patterns(summary: Dict[str, Any],
+                              figsize: Tuple[int, int] = (12, 6),
+                              fontsize: int = 12,
+                              color: Any = (0, 0, 0.2)) -> plt.Axes:
+    """
+    Plots the most frequent missingness patterns of @summary as a grid where
+    each row is a pattern and each non-null column is filled with @color, next
+    to the number of rows that follow each pattern. It replaces msno.matrix,
+    which draws every row of the dataframe.
+    """
+    fig, (ax, count_ax) = plt.subplots(
+        1, 2, figsize=figsize, sharey=True,
+        gridspec_kw={"width_ratios": [4, 1]})
+    ax.imshow(~summary["patterns"],
+              cmap=ListedColormap(["white", color]),
+              vmin=0, vmax=1, aspect="auto", interpolation="none")
+    ax.set_xticks(range(len(summary["columns"])))
+    ax.set_xticklabels(summary["columns"], rotation=45, ha="left",
+                       fontsize=fontsize)
+    ax.xaxis.tick_top()
+    ax.set_yticks(range(len(summary["pattern_counts"])))
+    ax.set_ylabel("Patrón de valores faltantes", fontsize=fontsize)
+    count_ax.barh(range(len(summary["pattern_counts"])),
+                  summary["pattern_counts"], color=color)
+    count_ax.set_xlabel("Filas", fontsize=fontsize)
+    return ax
+
+
+COLUMN_STATISTICS: "OrderedDict[Tuple[Any, Any], Dict[str, Any]]" = (
+    OrderedDict())
+MAX_CACHED_STATISTICS = 4096
+FINGERPRINT_SAMPLES = 64
+QUANTILE_SKETCH_LEVELS = np.linspace(0, 1, 101)
+DEFAULT_STATISTICS = ("count", "nulls", "mean", "variance", "std", "min",
+                      "max")
+
+
+def compute_statistics(matrix: np.array,
+                       statistics: Tuple[str, ...] = DEFAULT_STATISTICS
+                       ) -> List[Dict[str, Any]]:
+    """
+    Returns, for every column of the 2-D float array @matrix, a dictionary
+    with its @statistics ignoring nulls, out of: count, nulls, mean, variance
+    (population), std (sample), min, max and quantile_sketch (its quantiles at
+    every percentile). Each one is reduced along the rows of the whole matrix
+    at once, and only the requested ones are computed, so the quantile sketch,
+    which sorts every column, is skipped unless it is asked for.
+    """
+    wanted = set(statistics)
+    known = ~np.isnan(matrix)
+    count = known.sum(axis=0)
+    columns = {"count": count, "nulls": len(matrix) - count}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if wanted & {"mean", "variance", "std"}:
+            columns["mean"] = np.where(known, matrix, 0).sum(axis=0) / count
+        if wanted & {"variance", "std"}:
+            deviations = np.where(known, matrix - columns["mean"], 0)
+            columns["variance"] = (np.einsum("ij,ij->j", deviations,
+                                             deviations) / count)
+            columns["std"] = np.where(
+                count > 1,
+                np.sqrt(columns["variance"] * count / (count - 1)), np.nan)
+        if "min" in wanted:
+            columns["min"] = np.where(
+                count > 0, np.where(known, matrix, np.inf).min(axis=0),
+                np.nan)
+        if "max" in wanted:
+            columns["max"] = np.where(
+                count > 0, np.where(known, matrix, -np.inf).max(axis=0),
+                np.nan)
+    if "quantile_sketch" in wanted:
+        columns["quantile_sketch"] = np.full(
+            (len(QUANTILE_SKETCH_LEVELS), matrix.shape[1]), np.nan)
+        filled = count > 0
+        if filled.any():
+            columns["quantile_sketch"][:, filled] = np.nanquantile(
+                matrix[:, filled], QUANTILE_SKETCH_LEVELS, axis=0)
+        columns["quantile_sketch"] = columns["quantile_sketch"].T
+    return [{name: values[col]
+             for name, values in columns.items()
+             if name in wanted} for col in range(matrix.shape[1])]
+
+
+def sample_fingerprint(column: np.array) -> Tuple[int, bytes]:
+    """
+    Returns a cheap fingerprint of the 1-D float array @column: its length and
+    the bytes of at most FINGERPRINT_SAMPLES of its values, evenly spaced. It
+    tells apart data of another length or with other sampled values, though
+    not changes restricted to the rows left out of the sample.
+    """
+    step = max(1, len(column) // FINGERPRINT_SAMPLES)
+    return len(column), column[::step][:FINGERPRINT_SAMPLES].tobytes()
+
+
+def frame_statistics(values: Any,
+                     token: Any = None,
+                     names: Optional[List[Any]] = None,
+                     statistics: Tuple[str, ...] = DEFAULT_STATISTICS
+                     ) -> List[Dict[str, Any]]:
+    """
+    Returns the @statistics of every column of @values, a dataframe or 2-D
+    array, as given by compute_statistics. If a @token is given, it must
+    identify the version of the data the caller already tracks (a batch id,
+    a feature store version), and the statistics are cached in
+    COLUMN_STATISTICS under (@token, name), where the names are the columns
+    of @values, @names if given, or their positions otherwise. Columns shared
+    by several frames of the same version are then computed once, and only
+    the columns or statistics not cached yet are computed, in a single pass.
+
+    The token is the caller's promise that the data did not change: data that
+    change must get a new token. As a guard against stale tokens, each cached
+    column keeps its sample_fingerprint, and a column whose fingerprint no
+    longer matches is computed again. The cache keeps the last
+    MAX_CACHED_STATISTICS columns used and can be emptied with
+    clear_column_statistics.
+    """
+    matrix = np.asarray(values, dtype=np.float64)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(-1, 1)
+    if token is None:
+        return compute_statistics(matrix, statistics)
+
+    if names is None:
+        names = (list(values.columns) if isinstance(values, pd.DataFrame)
+                 else list(range(matrix.shape[1])))
+    keys = [(token, name) for name in names]
+    for position, key in enumerate(keys):
+        fingerprint = sample_fingerprint(matrix[:, position])
+        if COLUMN_STATISTICS.get(key, {}).get("fingerprint") != fingerprint:
+            COLUMN_STATISTICS[key] = {"fingerprint": fingerprint}
+    pending = [
+        position for position, key in enumerate(keys)
+        if not set(statistics) <= COLUMN_STATISTICS[key].keys()
+    ]
+    if pending:
+        pending_matrix = (matrix if len(pending) == matrix.shape[1] else
+                          matrix[:, pending])
+        computed = compute_statistics(pending_matrix, statistics)
+        for position, column in zip(pending, computed):
+            COLUMN_STATISTICS[keys[position]].update(column)
+    result = []
+    for key in keys:
+        COLUMN_STATISTICS.move_to_end(key)
+        result.append({name: value
+                       for name, value in COLUMN_STATISTICS[key].items()
+                       if name != "fingerprint"})
+    while len(COLUMN_STATISTICS) > MAX_CACHED_STATISTICS:
+        COLUMN_STATISTICS.popitem(last=False)
+    return result
+
+
+def column_statistics(values: Any,
+                      token: Any = None,
+                      statistics: Tuple[str, ...] = DEFAULT_STATISTICS
+                      ) -> Dict[str, Any]:
+    """
+    Returns the @statistics of the numeric column @values, as given by
+    frame_statistics. If a @token is given they are cached under the name of
+    @values, so it must be a named series.
+    """
+    return frame_statistics(values, token, [getattr(values, "name", None)],
+                            statistics)[0]
+
+
+def clear_column_statistics(token: Any = None) -> None:
+    """
+    Removes from COLUMN_STATISTICS the statistics cached with @token, or all
+    of them if not given.
+    """
+    if token is None:
+        COLUMN_STATISTICS.clear()
+        return
+    for key in [key for key in COLUMN_STATISTICS if key[0] == token]:
+        del COLUMN_STATISTICS[key]
+
+
+def sketch_quantile(statistics: Dict[str, Any], q: float) -> float:
+    """
+    Returns the quantile @q of a column, interpolated from the quantile sketch
+    of its @statistics as given by column_statistics with "quantile_sketch".
+    """
+    return float(np.interp(q, QUANTILE_SKETCH_LEVELS,
+                           statistics["quantile_sketch"]))
+
+
+NOTEBOOKS_DIR = os.path.dirname(os.path.abspath(__file__))
+MELB_HOUSING_PARTITIONS = os.path.join(NOTEBOOKS_DIR, "preprocess",
+                                       "melb_housing_df")
+MELB_SUBURB_PARTITIONS = os.path.join(NOTEBOOKS_DIR, "preprocess",
+                                      "melb_suburb_df")
+MELB_HOUSING_FILTERED_PARTITIONS = os.path.join(NOTEBOOKS_DIR, "exploration",
+                                                "melb_housing_filtered_df")
+MELB_SUBURB_FILTERED_PARTITIONS = os.path.join(NOTEBOOKS_DIR, "exploration",
+                                               "melb_suburb_filtered_df")
+ENCODED_MELB_PARTITIONS = os.path.join(NOTEBOOKS_DIR, "preprocess",
+                                       "encoded_melb_df")
+TARGET_ENCODED_PARTITIONS = os.path.join(NOTEBOOKS_DIR, "preprocess",
+                                         "target_encoded_df")
+
+
+def partition_path(directory: str, batch_id: str) -> str:
+    """
+    Returns the path of the partition @batch_id of the dataset stored in
+    @directory, one of the *_PARTITIONS roots.
+    """
+    return os.path.join(directory, f"part-{batch_id}.csv")
+
+
+def write_partition(df: pd.DataFrame, directory: str, batch_id: str) -> str:
+    """
+    Writes @df as the partition @batch_id of the dataset stored in @directory,
+    keeping its index, and returns the path of the written file. The roots
+    shared by the notebooks are the *_PARTITIONS constants, which do not
+    depend on the directory a notebook runs from.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = partition_path(directory, batch_id)
+    df.to_csv(path)
+    return path
+
+
+FEATURE_STORE_DIR = "feature_store"
+
+
+def index_by_sale_id(df: pd.DataFrame, source: str) -> pd.DataFrame:
+    """
+    Returns @df, read from @source with index_col=0, with its index named
+    sale_id. The first column of the file must hold the sale ids written by
+    to_csv, either with a sale_id header or unnamed. Otherwise, or if the ids
+    are not unique, raises ValueError: row positions are not a valid key of
+    the feature store.
+    """
+    if df.index.name not in (None, "sale_id"):
+        raise ValueError(
+            f"{source} has no sale_id column: its first column is "
+            f"{df.index.name!r}. Write it with its index, as "
+            "melbourne_exploration.ipynb does.")
+    if not df.index.is_unique:
+        raise ValueError(f"{source} has repeated sale ids")
+    return df.rename_axis("sale_id")
+
+
+def read_manifest(store_dir: str, group: str) -> Dict[str, Any]:
+    """
+    Returns the manifest of the feature @group in @store_dir, which lists its
+    versions with their file, columns and number of rows, or an empty one if
+    the group was never written.
+    """
+    path = os.path.join(store_dir, group, "manifest.json")
+    if not os.path.exists(path):
+        return {"group": group, "versions": []}
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_feature_group(df: pd.DataFrame, store_dir: str, group: str) -> int:
+    """
+    Writes @df, indexed by sale_id, as a new version of the feature @group in
+    @store_dir. Each version is a separate Parquet file, so the previous ones
+    are kept, and the manifest is replaced only once the file is complete.
+    Returns the number of the written version. Raises ValueError if the index
+    of @df is not named sale_id.
+    """
+    if df.index.name != "sale_id":
+        raise ValueError(f"Feature group {group} must be indexed by sale_id, "
+                         f"not {df.index.name!r}")
+    manifest = read_manifest(store_dir, group)
+    version = len(manifest["versions"]) + 1
+    group_dir = os.path.join(store_dir, group)
+    os.makedirs(group_dir, exist_ok=True)
+    file_name = f"v{version}.parquet"
+    df.to_parquet(os.path.join(group_dir, file_name))
+    manifest["versions"].append({
+        "version": version,
+        "file": file_name,
+        "columns": [str(col) for col in df.columns],
+        "rows": len(df),
+        "written_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    })
+    manifest_path = os.path.join(group_dir, "manifest.json")
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return version
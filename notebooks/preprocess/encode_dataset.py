@@ -13,7 +13,6 @@
 #     display_name: Python 3.8.5 64-bit ('usr')
 #     name: python385jvsc74a57bd031f2aee4e71d21fbe5cf8b01ff0e069b9275f58929596ceb00d14d90e3e16cd6
 # ---
-
 # %% [markdown]
 """
 # Diplomatura en Ciencias de Datos, Aprendizaje Automático y sus Aplicaciones
@@ -25,27 +24,62 @@ Autores: Matías Oria, Antonela Sambuceti, Pamela Pairo, Benjamín Ocampo
 ## Definición de funciones *helper*
 Inicialmente se definen funciones que se utilizaron durante la selección e
 imputación de columnas del conjunto de datos obtenido en
-`melbourne_exploration.py` y almacenados en un servidor para su acceso remoto.
+`melbourne_exploration.py`. Sus dos archivos se leen desde `EXPLORATION_DIR`,
+donde los escribe esa *notebook*, ya que la copia alojada en el servidor es
+anterior a la columna `housing_seller_agency` y al índice `sale_id`. Las
+funciones de medición de etapas, estadísticas por columna y almacén de
+*features* se importan de `notebooks/pipeline_helpers.py`, compartido con las
+otras *notebooks*.
 """
 # %%
+import ast
+import json
+import os
+import pickle
+import sys
+import time
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
 from sklearn.experimental import enable_iterative_imputer
 from sklearn import (base, decomposition, feature_extraction, impute,
                      neighbors, preprocessing)
-from typing import List, Tuple, Union
+from sklearn.utils.extmath import svd_flip
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+sys.path.insert(0, os.path.abspath(os.pardir))
+from pipeline_helpers import (ENCODED_MELB_PARTITIONS, FEATURE_STORE_DIR,
+                              MELB_HOUSING_FILTERED_PARTITIONS,
+                              MELB_SUBURB_FILTERED_PARTITIONS,
+                              TARGET_ENCODED_PARTITIONS,
+                              clear_column_statistics, frame_statistics,
+                              index_by_sale_id, partition_path, read_manifest,
+                              shape_of, track_stage, tracked,
+                              write_feature_group, write_partition,
+                              write_stage_report)
+
 
+EXPLORATION_DIR = os.path.join(os.pardir, "exploration")
+MELB_HOUSING_FILTERED_PATH = os.path.join(EXPLORATION_DIR,
+                                          "melb_housing_filtered_df.csv")
+MELB_SUBURB_FILTERED_PATH = os.path.join(EXPLORATION_DIR,
+                                         "melb_suburb_filtered_df.csv")
 
-def plot_imputation_graph(imputations: List[Tuple[str, pd.DataFrame]],
-                          missing_cols: List[str]) -> None:
+
+def plot_imputation_graph(
+        imputations: Union[List[Tuple[str, pd.DataFrame]], pd.DataFrame],
+        missing_cols: List[str]) -> None:
     """
     Makes a group of density plots according to the number of columns on the
     dataframes inside @imputations. @imputations must be a list of pairs
     (@method_name, @value_df) where each @value_df has the same @missing_cols
-    obtained by its corresponding imputer @method_name.
+    obtained by its corresponding imputer @method_name. It can also be a tidy
+    dataframe with a column "method", as returned by knn_imputation_sweep.
     """
+    if isinstance(imputations, pd.DataFrame):
+        imputations = list(imputations.groupby("method", sort=False))
     _, axs = plt.subplots(len(missing_cols), figsize=(10, 10))
     for ax, col_name in zip(axs, missing_cols):
         data = pd.concat([
@@ -55,6 +89,212 @@ def plot_imputation_graph(imputations: List[Tuple[str, pd.DataFrame]],
         seaborn.kdeplot(data=data, x=col_name, hue="method", ax=ax)
 
 
+def fit_cached_scaler(values: Union[np.array, pd.DataFrame],
+                      token: Any = None,
+                      names: Optional[List[Any]] = None
+                      ) -> preprocessing.StandardScaler:
+    """
+    Returns a StandardScaler fitted on @values, as StandardScaler().fit would,
+    but taking the mean and variance of each column from frame_statistics,
+    so columns already seen with the same @token and name (see
+    frame_statistics for @names) are not scanned again.
+    """
+    statistics = frame_statistics(values, token, names,
+                                  ("count", "mean", "variance"))
+    scaler = preprocessing.StandardScaler()
+    scaler.mean_ = np.array([stats["mean"] for stats in statistics])
+    scaler.var_ = np.array([stats["variance"] for stats in statistics])
+    scaler.scale_ = np.where(scaler.var_ > 0, np.sqrt(scaler.var_), 1.0)
+    counts = np.array([stats["count"] for stats in statistics])
+    scaler.n_samples_seen_ = (counts[0] if (counts == counts[0]).all()
+                              else counts)
+    scaler.n_features_in_ = len(statistics)
+    if isinstance(values, pd.DataFrame):
+        scaler.feature_names_in_ = np.asarray(values.columns, dtype=object)
+    return scaler
+
+
+def standardize(values: Union[np.array, pd.DataFrame],
+                token: Any = None,
+                names: Optional[List[Any]] = None) -> np.array:
+    """
+    Returns @values standardized by a scaler from fit_cached_scaler.
+    """
+    return fit_cached_scaler(values, token, names).transform(values)
+
+
+def parse_list_value(value: Any) -> List[Any]:
+    """
+    Returns @value as a list: lists, tuples and arrays are kept, strings such
+    as "['Yarra', 'Boroondara']" written by to_csv are parsed, any other string
+    is a list of one item and missing values are empty lists.
+    """
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return list(value)
+    if not isinstance(value, str):
+        return []
+    if value.startswith("["):
+        return list(ast.literal_eval(value))
+    return [value]
+
+
+def parse_list_column(column: pd.Series) -> pd.Series:
+    """
+    Returns @column with every value converted by parse_list_value. Columns of
+    strings are factorized first, so each distinct value is parsed only once.
+    """
+    try:
+        codes, uniques = pd.factorize(column)
+    except TypeError:
+        return column.map(parse_list_value)
+    parsed = [parse_list_value(value) for value in uniques] + [[]]
+    return pd.Series([parsed[code] for code in codes],
+                     index=column.index,
+                     name=column.name)
+
+
+def multi_hot_encode(
+        column: pd.Series,
+        vocabulary: Optional[List[Any]] = None,
+        n_features: Optional[int] = None
+) -> Tuple[sparse.csr_matrix, List[str]]:
+    """
+    Returns a sparse CSR matrix with a row per value of @column, which may hold
+    lists (as parsed by parse_list_column) or single values, and a 1 in the
+    column of every item of the row, along with the names of the columns in
+    the DictVectorizer style <column>=<item>. Columns follow @vocabulary,
+    learned from @column if not given, and items outside of it are ignored.
+    If @n_features is given, items are hashed into that fixed number of
+    columns with FeatureHasher instead, so no vocabulary is kept and unseen
+    items still have a column, at the cost of collisions.
+    """
+    lists = parse_list_column(column)
+    items = [str(item) for values in lists for item in values]
+    if n_features is not None:
+        hasher = feature_extraction.FeatureHasher(n_features=n_features,
+                                                  input_type="string",
+                                                  alternate_sign=False)
+        matrix = hasher.transform(
+            [[str(item) for item in values] for values in lists]).tocsr()
+        names = [f"{column.name}#{position}" for position in range(n_features)]
+    else:
+        vocabulary = pd.Index(
+            sorted(set(items)) if vocabulary is None else vocabulary)
+        columns = vocabulary.get_indexer(items)
+        rows = np.repeat(np.arange(len(lists)), lists.map(len).to_numpy())
+        known = columns >= 0
+        matrix = sparse.csr_matrix(
+            (np.ones(known.sum()), (rows[known], columns[known])),
+            shape=(len(lists), len(vocabulary)))
+        names = [f"{column.name}={item}" for item in vocabulary]
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix, names
+
+
+def target_encode_out_of_fold(
+        keys: pd.Series,
+        target: Union[np.array, pd.Series],
+        nof_folds: int = 5,
+        smoothing: float = 10.0,
+        random_state: int = 0) -> Tuple[np.array, Dict[str, Any]]:
+    """
+    Replaces every value of the high-cardinality column @keys by the smoothed
+    mean of @target over the rows with the same key, (sum + @smoothing *
+    prior) / (count + @smoothing), where prior is the mean of @target. To
+    avoid leaking the target of a row into its own encoding, rows are split in
+    @nof_folds random folds and each one is encoded with the statistics of the
+    other folds. The keys are factorized and the sums and counts of every
+    (fold, key) pair are computed at once with np.bincount, so all folds are
+    obtained in a single pass. Missing keys are a key of their own and missing
+    targets are ignored. Returns the out-of-fold encoding and the mapping
+    fitted on all rows that target_encode_transform applies to new data.
+    """
+    codes, categories = pd.factorize(keys)
+    nof_codes = len(categories) + 1
+    codes = np.where(codes < 0, nof_codes - 1, codes)
+    target = np.asarray(target, dtype=float)
+    known = ~np.isnan(target)
+    folds = (np.random.default_rng(random_state).permutation(len(codes)) %
+             nof_folds)
+
+    cells = folds * nof_codes + codes
+    sums = np.bincount(cells,
+                       np.where(known, target, 0),
+                       minlength=nof_folds * nof_codes).reshape(
+                           nof_folds, nof_codes)
+    counts = np.bincount(cells, known,
+                         minlength=nof_folds * nof_codes).reshape(
+                             nof_folds, nof_codes)
+
+    out_of_fold_sums = sums.sum(axis=0) - sums
+    out_of_fold_counts = counts.sum(axis=0) - counts
+    fold_priors = out_of_fold_sums.sum(axis=1) / out_of_fold_counts.sum(axis=1)
+    encoding = ((out_of_fold_sums + smoothing * fold_priors[:, np.newaxis]) /
+                (out_of_fold_counts + smoothing))
+
+    prior = target[known].mean()
+    values = ((sums.sum(axis=0) + smoothing * prior) /
+              (counts.sum(axis=0) + smoothing))
+    mapping = {
+        "categories": list(categories),
+        "values": values[:-1],
+        "missing": values[-1],
+        "prior": prior,
+    }
+    return encoding[folds, codes], mapping
+
+
+def target_encode_transform(keys: pd.Series,
+                            mapping: Dict[str, Any]) -> np.array:
+    """
+    Encodes @keys with the @mapping returned by target_encode_out_of_fold.
+    Keys not seen when fitting it are encoded with the prior.
+    """
+    positions = pd.Index(mapping["categories"]).get_indexer(keys)
+    encoded = np.where(positions >= 0,
+                       np.append(mapping["values"], np.nan)[positions],
+                       mapping["prior"])
+    return np.where(pd.isna(keys), mapping["missing"], encoded)
+
+
+def require_columns(df: pd.DataFrame, columns: List[str]) -> None:
+    """
+    Raises KeyError naming the @columns missing in @df, which are selected by
+    melbourne_exploration.ipynb and are absent from outputs written before it
+    selected them.
+    """
+    missing = [col for col in columns if col not in df]
+    if missing:
+        raise KeyError(
+            f"Missing columns {missing}: run melbourne_exploration.ipynb "
+            f"again to write {MELB_HOUSING_FILTERED_PATH} and its partitions "
+            "with them")
+
+
+def target_encode_frame(df: pd.DataFrame,
+                        mappings: Dict[str, Dict[str, Any]]) -> pd.DataFrame:
+    """
+    Returns a dataframe with a column <column>_target per column of @mappings,
+    encoding that column of @df with target_encode_transform. Raises KeyError
+    if @df lacks any of those columns.
+    """
+    require_columns(df, list(mappings))
+    return pd.DataFrame(
+        {
+            f"{col}_target": target_encode_transform(df[col], mapping)
+            for col, mapping in mappings.items()
+        },
+        index=df.index)
+
+
+def sparse_nbytes(matrix: sparse.csr_matrix) -> int:
+    """
+    Returns the bytes used by the data and indices of the CSR @matrix.
+    """
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
 def impute_by(values: Union[np.array, pd.DataFrame],
               missing_col_names: List[str],
               estimator: base.BaseEstimator) -> pd.DataFrame:
@@ -65,6 +305,19 @@ def impute_by(values: Union[np.array, pd.DataFrame],
     the IterativeImputer class takes advantage of it in order to estimate
     missing values.
     """
+    imputed_df, _ = fit_impute_by(values, missing_col_names, estimator)
+    return imputed_df
+
+
+@tracked
+def fit_impute_by(
+        values: Union[np.array, pd.DataFrame], missing_col_names: List[str],
+        estimator: base.BaseEstimator
+) -> Tuple[pd.DataFrame, impute.IterativeImputer]:
+    """
+    Same as impute_by but also returns the fitted IterativeImputer, so it can be
+    used later to impute new rows with the same columns as @values.
+    """
     indicator = impute.MissingIndicator()
     indicator.fit_transform(values)
 
@@ -73,13 +326,525 @@ def impute_by(values: Union[np.array, pd.DataFrame],
     imputed_values = imputer.fit_transform(values)
     imputed_df = pd.DataFrame(imputed_values[:, indicator.features_],
                               columns=missing_col_names)
-    return imputed_df
-# %%
-URL_MELB_HOUSING_FILTERED = "https://www.famaf.unc.edu.ar/~nocampo043/melb_housing_filtered_df.csv"
-URL_MELB_SUBURB_FILTERED = "https://www.famaf.unc.edu.ar/~nocampo043/melb_suburb_filtered_df.csv"
+    return imputed_df, imputer
+
+
+def knn_imputation_sweep(targets_df: pd.DataFrame,
+                         feature_sets: Dict[str, Union[np.array,
+                                                       pd.DataFrame]],
+                         k_values: List[int],
+                         weightings: Tuple[str, ...] = ("uniform", "distance")
+                         ) -> pd.DataFrame:
+    """
+    Imputes the null entries of each column of @targets_df with the mean of its
+    k nearest neighbours among the rows where it is known, for every k in
+    @k_values, every weighting in @weightings ("uniform" or "distance", as in
+    KNeighborsRegressor) and every feature matrix in @feature_sets, which maps
+    a name to an array or dataframe with the rows of @targets_df. A dataframe
+    may hold the columns of @targets_df themselves: each column is then left
+    out of its own features. Only complete cases are used: rows with missing
+    features are neither neighbours nor imputed, and keep their null entries.
+
+    The neighbours are searched only once per feature set and column, for the
+    largest k, and every other configuration is obtained by slicing them.
+    Equidistant neighbours are ordered by row, so the slices are consistent.
+    Returns a tidy dataframe with the imputed @targets_df of each configuration
+    stacked, along with the columns method, features, k and weights.
+    """
+    max_k = max(k_values)
+    imputations = {
+        (name, k, weights): targets_df.copy()
+        for name in feature_sets for k in k_values for weights in weightings
+    }
+    for name, features in feature_sets.items():
+        for col in targets_df:
+            col_features = np.asarray(
+                features.drop(columns=col, errors="ignore")
+                if isinstance(features, pd.DataFrame) else features,
+                dtype=float)
+            complete = ~np.isnan(col_features).any(axis=1)
+            known = targets_df[col].notna().to_numpy() & complete
+            missing = targets_df[col].isna().to_numpy() & complete
+            if not missing.any():
+                continue
+            search = neighbors.NearestNeighbors(n_neighbors=max_k).fit(
+                col_features[known])
+            distances, indices = search.kneighbors(col_features[missing])
+            by_row = np.argsort(indices, axis=1)
+            by_distance = np.take_along_axis(
+                by_row,
+                np.argsort(np.take_along_axis(distances, by_row, axis=1),
+                           axis=1, kind="stable"),
+                axis=1)
+            distances = np.take_along_axis(distances, by_distance, axis=1)
+            indices = np.take_along_axis(indices, by_distance, axis=1)
+            neighbour_values = targets_df[col].to_numpy()[known][indices]
+            for k in k_values:
+                for weights in weightings:
+                    if weights == "uniform":
+                        coefficients = np.ones((len(indices), k))
+                    else:
+                        with np.errstate(divide="ignore"):
+                            coefficients = 1 / distances[:, :k]
+                        exact = np.isinf(coefficients).any(axis=1)
+                        coefficients[exact] = np.isinf(coefficients[exact])
+                    imputations[(name, k, weights)].loc[missing, col] = (
+                        (coefficients * neighbour_values[:, :k]).sum(axis=1) /
+                        coefficients.sum(axis=1))
+    return pd.concat([
+        imputation_df.assign(method=f"knn k={k} {weights} - {name}",
+                             features=name, k=k, weights=weights)
+        for (name, k, weights), imputation_df in imputations.items()
+    ], ignore_index=True)
+
+
+def neighbour_graph(features: np.array,
+                    k: int) -> Tuple[np.array, np.array]:
+    """
+    Returns the distances and indices of the @k nearest neighbours of every row
+    of @features among the other rows, sorted by distance. The graph only
+    depends on the features, so it can be computed once and reused to impute
+    any column under any mask.
+    """
+    search = neighbors.NearestNeighbors(n_neighbors=k + 1).fit(features)
+    distances, indices = search.kneighbors(features)
+    return distances[:, 1:], indices[:, 1:]
+
+
+def impute_column_means(values: np.array) -> np.array:
+    """
+    Returns @values with the null entries of each column replaced by its mean.
+    """
+    return np.where(np.isnan(values), np.nanmean(values, axis=0), values)
+
+
+def impute_from_graph(values: np.array,
+                      graph: Tuple[np.array, np.array],
+                      k: int) -> np.array:
+    """
+    Returns @values with each null entry replaced by the mean of the first @k
+    neighbours of its row in @graph, as built by neighbour_graph, that know the
+    value of the column. Entries without any such neighbour take the mean of
+    the column.
+    """
+    _, indices = graph
+    neighbour_values = values[indices]
+    known = ~np.isnan(neighbour_values)
+    used = known & (np.cumsum(known, axis=1) <= k)
+    counts = used.sum(axis=1)
+    with np.errstate(invalid="ignore"):
+        means = np.where(used, neighbour_values, 0).sum(axis=1) / counts
+    means = np.where(counts > 0, means, np.nanmean(values, axis=0))
+    return np.where(np.isnan(values), means, values)
+
+
+def impute_iteratively(values: np.array,
+                       features: np.array,
+                       estimator: Optional[base.BaseEstimator] = None
+                       ) -> np.array:
+    """
+    Returns @values with its null entries estimated by an IterativeImputer with
+    @estimator (BayesianRidge by default) that also uses @features.
+    """
+    imputer = impute.IterativeImputer(random_state=0, estimator=estimator)
+    return imputer.fit_transform(np.hstack([values, features]))[
+        :, :values.shape[1]]
+
+
+IMPUTATION_STRATEGIES: Dict[str, Callable[..., np.array]] = {
+    "mean": lambda values, features, graph: impute_column_means(values),
+    "knn graph k=2": lambda values, features, graph: impute_from_graph(
+        values, graph, k=2),
+    "knn graph k=5": lambda values, features, graph: impute_from_graph(
+        values, graph, k=5),
+    "iterative": lambda values, features, graph: impute_iteratively(
+        values, features),
+    "iterative knn": lambda values, features, graph: impute_iteratively(
+        values, features, neighbors.KNeighborsRegressor(n_neighbors=2)),
+}
+_EVALUATION_DATA: Dict[str, Any] = {}
+
+
+def mask_known_values(values: np.array,
+                      fraction: float,
+                      pattern: str,
+                      rng: np.random.Generator,
+                      driver: Optional[np.array] = None) -> np.array:
+    """
+    Returns a mask of @fraction of the known entries of each column of
+    @values, to be hidden and then imputed. @pattern sets how they are chosen:
+    "mcar" uniformly at random, "mar" with a probability proportional to the
+    rank of @driver in the row, and "rows" hiding whole rows where every column
+    is known.
+    """
+    known = ~np.isnan(values)
+    mask = np.zeros_like(known)
+    if pattern == "rows":
+        rows = np.flatnonzero(known.all(axis=1))
+        hidden = rng.choice(rows, int(fraction * len(rows)), replace=False)
+        mask[hidden] = True
+        return mask
+    if pattern not in ("mcar", "mar"):
+        raise ValueError(f"Unknown missingness pattern {pattern}")
+    for col in range(values.shape[1]):
+        rows = np.flatnonzero(known[:, col])
+        probabilities = None
+        if pattern == "mar":
+            ranks = pd.Series(driver[rows]).rank().to_numpy()
+            probabilities = ranks / ranks.sum()
+        hidden = rng.choice(rows, int(fraction * len(rows)), replace=False,
+                            p=probabilities)
+        mask[hidden, col] = True
+    return mask
+
+
+def _attach_evaluation_data(matrix_path: str, group: str,
+                            evaluation_path: str,
+                            neighbours_path: str) -> None:
+    """
+    Attaches, in the process that runs score_imputation, the data shared by
+    every task of evaluate_imputers: the features of @group of the matrix
+    published in @matrix_path, the evaluated values and neighbour distances
+    published in @evaluation_path and the neighbour indices published in
+    @neighbours_path. Every process maps the same files instead of receiving
+    a copy of the arrays.
+    """
+    matrix, header = attach_feature_matrix(matrix_path)
+    evaluation, evaluation_header = attach_feature_matrix(evaluation_path)
+    indices, _ = attach_feature_matrix(neighbours_path)
+    values_df = feature_group(evaluation, evaluation_header, "values")
+    _EVALUATION_DATA.update({
+        "values": values_df.to_numpy(),
+        "features": feature_group(matrix, header, group).to_numpy(),
+        "graph": (feature_group(evaluation, evaluation_header,
+                                "distances").to_numpy(), indices),
+        "columns": list(values_df.columns),
+    })
+
+
+def score_imputation(task: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Hides the entries in the mask of @task, imputes them with its strategy and
+    returns the seconds taken along with the RMSE and MAE of each column over
+    the hidden entries.
+    """
+    values = _EVALUATION_DATA["values"]
+    mask = task["mask"]
+    masked_values = np.where(mask, np.nan, values)
+    start = time.perf_counter()
+    imputed = IMPUTATION_STRATEGIES[task["strategy"]](
+        masked_values, _EVALUATION_DATA["features"], _EVALUATION_DATA["graph"])
+    result = {
+        "pattern": task["pattern"],
+        "fold": task["fold"],
+        "strategy": task["strategy"],
+        "seconds": time.perf_counter() - start,
+    }
+    for col, name in enumerate(_EVALUATION_DATA["columns"]):
+        errors = imputed[mask[:, col], col] - values[mask[:, col], col]
+        result[f"{name}_rmse"] = np.sqrt(np.mean(errors**2))
+        result[f"{name}_mae"] = np.mean(np.abs(errors))
+    return result
+
+
+def evaluate_imputers(values_df: pd.DataFrame,
+                      matrix_path: str,
+                      group: str,
+                      graph: Tuple[np.array, np.array],
+                      strategies: List[str],
+                      patterns: List[str],
+                      fraction: float = 0.1,
+                      nof_folds: int = 5,
+                      driver: Optional[np.array] = None,
+                      n_jobs: Optional[int] = None,
+                      random_state: int = 0) -> pd.DataFrame:
+    """
+    Masks @fraction of the known values of the columns of @values_df with each
+    missingness pattern in @patterns (see mask_known_values) @nof_folds times,
+    and imputes them with every strategy of IMPUTATION_STRATEGIES named in
+    @strategies. The features are the columns of the feature @group of the
+    matrix published in @matrix_path, which must be complete and have the rows
+    of @values_df, and @graph is their neighbour_graph, computed only once for
+    every fold and strategy. The values and @graph are published next to
+    @matrix_path, so the pool of @n_jobs processes that run the tasks attach
+    to the same files instead of receiving copies. Returns one row per
+    pattern, fold and strategy with its seconds, RMSE and MAE of each column.
+    """
+    values = values_df.to_numpy(dtype=float)
+    rng = np.random.default_rng(random_state)
+    tasks = [
+        {"pattern": pattern, "fold": fold, "strategy": strategy, "mask": mask}
+        for pattern in patterns
+        for fold in range(nof_folds)
+        for mask in [mask_known_values(values, fraction, pattern, rng, driver)]
+        for strategy in strategies
+    ]
+    distances, indices = graph
+    evaluation_path = publish_feature_matrix(
+        np.hstack([values, distances]),
+        f"{matrix_path}.evaluation",
+        columns=(list(values_df.columns) +
+                 [f"distance_{k}" for k in range(distances.shape[1])]),
+        groups={"values": (0, values.shape[1]),
+                "distances": (values.shape[1],
+                              values.shape[1] + distances.shape[1])})
+    neighbours_path = publish_feature_matrix(
+        indices,
+        f"{matrix_path}.neighbours",
+        columns=[f"neighbour_{k}" for k in range(indices.shape[1])],
+        groups={"indices": (0, indices.shape[1])})
+    paths = (matrix_path, group, evaluation_path, neighbours_path)
+    try:
+        if n_jobs is None or n_jobs == 1:
+            _attach_evaluation_data(*paths)
+            results = list(map(score_imputation, tasks))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=_attach_evaluation_data,
+                                     initargs=paths) as executor:
+                results = list(executor.map(score_imputation, tasks))
+    finally:
+        _EVALUATION_DATA.clear()
+        os.remove(evaluation_path)
+        os.remove(neighbours_path)
+    return pd.DataFrame(results)
+
+
+@tracked
+def implicit_pca(sparse_block: sparse.csr_matrix,
+                 dense_block: np.array,
+                 n_components: int,
+                 n_oversamples: int = 10,
+                 n_iter: int = 4,
+                 random_state: int = 0) -> Tuple[np.array, np.array, np.array]:
+    """
+    Computes the principal components of the standardized columns of
+    [@sparse_block | @dense_block], as StandardScaler followed by PCA would,
+    without building a dense or centered copy of @sparse_block. The column
+    means and scales are applied implicitly inside the matrix products of a
+    randomized SVD with @n_oversamples extra vectors and @n_iter power
+    iterations. Returns the projection of the rows on the first @n_components
+    components, the components and their explained variance ratio.
+    """
+    sparse_block = sparse.csr_matrix(sparse_block, dtype=np.float64)
+    dense_block = np.asarray(dense_block, dtype=np.float64)
+    nof_rows = sparse_block.shape[0]
+    nof_sparse_cols = sparse_block.shape[1]
+
+    means = np.concatenate([np.asarray(sparse_block.mean(axis=0)).ravel(),
+                            dense_block.mean(axis=0)])
+    squares = np.concatenate([
+        np.asarray(sparse_block.multiply(sparse_block).mean(axis=0)).ravel(),
+        (dense_block**2).mean(axis=0)
+    ])
+    scales = np.sqrt(np.clip(squares - means**2, 0, None))
+    scales[scales == 0] = 1
+
+    def product(vectors: np.array) -> np.array:
+        vectors = vectors / scales[:, np.newaxis]
+        return (sparse_block @ vectors[:nof_sparse_cols] +
+                dense_block @ vectors[nof_sparse_cols:] - means @ vectors)
+
+    def transposed_product(vectors: np.array) -> np.array:
+        products = np.vstack([sparse_block.T @ vectors,
+                              dense_block.T @ vectors])
+        return (products - np.outer(means, vectors.sum(axis=0))) / scales[
+            :, np.newaxis]
 
-melb_housing_df = pd.read_csv(URL_MELB_HOUSING_FILTERED)
-melb_suburb_df = pd.read_csv(URL_MELB_SUBURB_FILTERED)
+    nof_cols = len(means)
+    nof_vectors = min(n_components + n_oversamples, nof_cols, nof_rows)
+    rng = np.random.default_rng(random_state)
+    basis, _ = np.linalg.qr(product(rng.normal(size=(nof_cols, nof_vectors))))
+    for _ in range(n_iter):
+        row_basis, _ = np.linalg.qr(transposed_product(basis))
+        basis, _ = np.linalg.qr(product(row_basis))
+
+    left, singular_values, components = np.linalg.svd(
+        transposed_product(basis).T, full_matrices=False)
+    left, components = svd_flip(basis @ left, components,
+                                u_based_decision=False)
+    explained_variance = singular_values**2 / (nof_rows - 1)
+    total_variance = (np.count_nonzero(squares - means**2 > 1e-12 * squares) *
+                      nof_rows / (nof_rows - 1))
+    return ((left * singular_values)[:, :n_components],
+            components[:n_components],
+            (explained_variance / total_variance)[:n_components])
+
+
+def feature_group_path(store_dir: str, group: str,
+                       version: Optional[int] = None) -> str:
+    """
+    Returns the file of the @version of the feature @group in @store_dir, or of
+    its latest version if @version is None.
+    """
+    versions = read_manifest(store_dir, group)["versions"]
+    if not versions:
+        raise KeyError(f"Feature group {group} not found in {store_dir}")
+    entry = versions[-1] if version is None else next(
+        entry for entry in versions if entry["version"] == version)
+    return os.path.join(store_dir, group, entry["file"])
+
+
+def read_features(store_dir: str,
+                  columns: Dict[str, Optional[List[str]]],
+                  filters: Optional[List[Tuple[str, str, Any]]] = None,
+                  versions: Optional[Dict[str, int]] = None) -> pd.DataFrame:
+    """
+    Reads only the @columns of each feature group of @store_dir, given as a
+    dictionary from group to column names (None for all of them), and joins
+    them by sale_id. @filters are (column, operator, value) predicates, as
+    accepted by pd.read_parquet, that are pushed down to the group that has
+    the column, and only sales that pass all of them are kept. Groups are read
+    in their latest version unless @versions says otherwise.
+    """
+    versions = versions or {}
+    filters = filters or []
+    groups_df = []
+    for group, group_columns in columns.items():
+        available = read_manifest(store_dir, group)["versions"][-1]["columns"]
+        group_filters = [predicate for predicate in filters
+                         if predicate[0] in available or
+                         predicate[0] == "sale_id"]
+        filter_columns = [predicate[0] for predicate in group_filters
+                          if predicate[0] != "sale_id"]
+        read_columns = (None if group_columns is None else
+                        list(dict.fromkeys(group_columns + filter_columns)))
+        group_df = pd.read_parquet(
+            feature_group_path(store_dir, group, versions.get(group)),
+            columns=read_columns,
+            filters=group_filters or None)
+        if group_columns is not None:
+            group_df = group_df[group_columns]
+        groups_df.append(group_df)
+    return pd.concat(groups_df, axis=1, join="inner")
+
+
+def lookup_features(store_dir: str,
+                    group: str,
+                    sale_ids: List[int],
+                    columns: Optional[List[str]] = None,
+                    version: Optional[int] = None) -> pd.DataFrame:
+    """
+    Returns the @columns of the feature @group in @store_dir for the sales in
+    @sale_ids only.
+    """
+    return pd.read_parquet(feature_group_path(store_dir, group, version),
+                           columns=columns,
+                           filters=[("sale_id", "in", list(sale_ids))])
+
+
+FEATURE_MATRIX_MAGIC = b"MELBMAT1"
+
+
+def _feature_matrix_offset(header_size: int) -> int:
+    """
+    Returns the offset of the data of a published feature matrix whose header
+    has @header_size bytes, aligned to 64 bytes.
+    """
+    return -(-(len(FEATURE_MATRIX_MAGIC) + 8 + header_size) // 64) * 64
+
+
+def publish_feature_matrix(matrix: np.array,
+                           path: str,
+                           columns: List[str],
+                           groups: Dict[str, Tuple[int, int]]) -> str:
+    """
+    Writes @matrix once to @path so that other processes can attach to it with
+    attach_feature_matrix without copying it. The file starts with a small JSON
+    header with the dtype, the shape, the @columns names and the feature
+    @groups, which map a name to the range [start, stop) of its columns,
+    followed by the raw data in row-major order. The file is written under a
+    temporary name and then renamed, so readers never see it half written.
+    """
+    matrix = np.ascontiguousarray(matrix)
+    header = json.dumps({
+        "dtype": matrix.dtype.str,
+        "shape": list(matrix.shape),
+        "columns": list(columns),
+        "groups": {name: list(bounds) for name, bounds in groups.items()},
+    }).encode()
+    offset = _feature_matrix_offset(len(header))
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as matrix_file:
+        matrix_file.write(FEATURE_MATRIX_MAGIC)
+        matrix_file.write(len(header).to_bytes(8, "little"))
+        matrix_file.write(header.ljust(offset - len(FEATURE_MATRIX_MAGIC) - 8))
+        matrix.tofile(matrix_file)
+    os.replace(temporary_path, path)
+    return path
+
+
+def attach_feature_matrix(path: str) -> Tuple[np.memmap, Dict[str, Any]]:
+    """
+    Maps the feature matrix published in @path as a read-only array, shared
+    with every other process that attaches to it. Returns the array and its
+    header, as written by publish_feature_matrix.
+    """
+    with open(path, "rb") as matrix_file:
+        if matrix_file.read(len(FEATURE_MATRIX_MAGIC)) != FEATURE_MATRIX_MAGIC:
+            raise ValueError(f"{path} is not a published feature matrix")
+        header_size = int.from_bytes(matrix_file.read(8), "little")
+        header = json.loads(matrix_file.read(header_size))
+    matrix = np.memmap(path,
+                       dtype=np.dtype(header["dtype"]),
+                       mode="r",
+                       offset=_feature_matrix_offset(header_size),
+                       shape=tuple(header["shape"]))
+    return matrix, header
+
+
+def feature_group(matrix: np.array, header: Dict[str, Any],
+                  group: str) -> pd.DataFrame:
+    """
+    Returns the columns of the feature @group of an attached @matrix as a
+    dataframe that views its memory instead of copying it.
+    """
+    start, stop = header["groups"][group]
+    return pd.DataFrame(matrix[:, start:stop],
+                        columns=header["columns"][start:stop],
+                        copy=False)
+
+
+def append_encoded_batch(housing_batch_df: pd.DataFrame,
+                         suburb_df: pd.DataFrame,
+                         state: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Encodes only a new batch of filtered sales @housing_batch_df, whose
+    suburb_id refer to the rows of @suburb_df. The fitted vectorizer, imputer,
+    scaler and PCA are taken from @state, the dictionary saved at the end of
+    this notebook, so nothing is refitted. Returns the encoded rows with the
+    same columns as encoded_melb_df, keeping the index of @housing_batch_df.
+    """
+    combined_df = housing_batch_df.join(suburb_df, on="suburb_id")
+    features = list(combined_df[state["feature_cols"]].T.to_dict().values())
+    batch_matrix = state["vectorizer"].transform(features).todense()
+
+    missing_cols = state["missing_cols"]
+    imputed_values = state["imputer"].transform(
+        np.hstack([combined_df[missing_cols], batch_matrix]))
+    batch_matrix = np.hstack(
+        [batch_matrix, imputed_values[:, :len(missing_cols)]])
+
+    principal_components = state["pca"].transform(
+        state["pca_scaler"].transform(batch_matrix))
+    return pd.DataFrame(
+        data=np.hstack([
+            batch_matrix,
+            principal_components[:, :state["nof_selected_components"]]
+        ]),
+        columns=state["columns"],
+        index=housing_batch_df.index)
+# %%
+with track_stage("read_housing_csv") as stage:
+    melb_housing_df = index_by_sale_id(
+        pd.read_csv(MELB_HOUSING_FILTERED_PATH, index_col=0),
+        MELB_HOUSING_FILTERED_PATH)
+    stage["shape_out"] = shape_of(melb_housing_df)
+with track_stage("read_suburb_csv") as stage:
+    melb_suburb_df = pd.read_csv(MELB_SUBURB_FILTERED_PATH)
+    stage["shape_out"] = shape_of(melb_suburb_df)
+data_version = "full"
+clear_column_statistics()
 melb_combined_df = melb_housing_df.join(melb_suburb_df, on="suburb_id")
 melb_combined_df
 # %% [markdown]
@@ -105,7 +870,9 @@ feature_cols = categorical_cols + numerical_cols
 features = list(melb_combined_df[feature_cols].T.to_dict().values())
 
 vectorizer = feature_extraction.DictVectorizer()
-feature_matrix = vectorizer.fit_transform(features)
+with track_stage("dict_vectorizer", melb_combined_df[feature_cols]) as stage:
+    feature_matrix = vectorizer.fit_transform(features)
+    stage["shape_out"] = shape_of(feature_matrix)
 feature_matrix
 # %%
 vectorizer.get_feature_names()
@@ -123,6 +890,105 @@ obstante, se trabajó sobre la matriz dada por el método `Dict Vectorizer`.
 """
 # %% [markdown]
 """
+### Matriz compartida
+Las variantes de imputación, el barrido de hiperparámetros, la evaluación de
+estrategias y el `PCA` usan la matriz codificada, y cada una de ellas obtenía su
+propia copia densa con `todense`. Por ello, apenas se codifica, la matriz se
+publica una única vez junto a su versión estandarizada en un archivo con un
+pequeño encabezado (nombres de columnas, tipo de datos y grupos de *features*)
+por medio de `publish_feature_matrix`. Cada consumidor la mapea en memoria como
+un arreglo de solo lectura con `attach_feature_matrix` y toma sus columnas con
+`feature_group`, de manera que todos comparten las mismas páginas, incluidos
+los procesos de `evaluate_imputers`, y ejecutar varios experimentos en paralelo
+no multiplica la memoria utilizada.
+"""
+# %%
+ENCODED_FEATURES_PATH = "encoded_features.mmap"
+
+encoded_cols = vectorizer.get_feature_names()
+dense_features = feature_matrix.toarray()
+publish_feature_matrix(
+    np.hstack([dense_features,
+               standardize(dense_features, data_version, encoded_cols)]),
+    ENCODED_FEATURES_PATH,
+    columns=encoded_cols + [f"{col}_scaled" for col in encoded_cols],
+    groups={
+        "encoded": (0, len(encoded_cols)),
+        "encoded_scaled": (len(encoded_cols), 2 * len(encoded_cols)),
+    })
+del dense_features
+
+shared_features, shared_features_header = attach_feature_matrix(
+    ENCODED_FEATURES_PATH)
+encoded_features = feature_group(shared_features, shared_features_header,
+                                 "encoded").to_numpy()
+scaled_encoded_features = feature_group(
+    shared_features, shared_features_header, "encoded_scaled").to_numpy()
+np.shares_memory(encoded_features, shared_features)
+# %% [markdown]
+"""
+### Variables con listas de valores
+`suburb_council_area` contiene la lista de municipios a los que pertenece cada
+suburbio, que luego de guardarse como `.csv` se lee como el texto de dicha
+lista. `multi_hot_encode` interpreta estas listas con `parse_list_column` y
+genera directamente una matriz dispersa en formato CSR con un 1 por cada
+municipio del suburbio, sin pasar por una matriz densa. Para variables con
+muchos valores distintos como `suburb_name`, se puede fijar en cambio la
+cantidad de columnas con `n_features`, en cuyo caso cada valor se asigna a una
+columna por medio de una función de *hash*. Ambas matrices ocupan una pequeña
+fracción de la memoria de su equivalente denso, por lo que pueden agregarse a
+la matriz de `DictVectorizer` para los modelos que aceptan matrices dispersas.
+"""
+# %%
+council_matrix, council_features = multi_hot_encode(
+    melb_combined_df["suburb_council_area"])
+suburb_matrix, suburb_features = multi_hot_encode(
+    melb_combined_df["suburb_name"], n_features=256)
+list_feature_matrix = sparse.hstack(
+    [feature_matrix, council_matrix, suburb_matrix], format="csr")
+
+pd.DataFrame(
+    {
+        "columns": [matrix.shape[1] for matrix in [council_matrix,
+                                                    suburb_matrix]],
+        "sparse_mb": [
+            sparse_nbytes(matrix) / 2**20
+            for matrix in [council_matrix, suburb_matrix]
+        ],
+        "dense_mb": [
+            np.prod(matrix.shape) * 8 / 2**20
+            for matrix in [council_matrix, suburb_matrix]
+        ],
+    },
+    index=["suburb_council_area", "suburb_name"])
+# %% [markdown]
+"""
+### Codificación por objetivo
+Las variables `housing_seller_agency` y `suburb_name` tienen cientos de valores
+distintos, por lo que su codificación *one-hot* agregaría cientos de columnas.
+En su lugar, `target_encode_out_of_fold` reemplaza cada valor por el precio
+medio de venta de las propiedades con ese mismo valor, suavizado hacia el
+precio medio general cuando hay pocas ventas. Para que el precio de una venta no
+forme parte de su propia codificación, las filas se dividen en 5 particiones y
+cada una se codifica con las estadísticas de las restantes, calculando todas
+las particiones en una única pasada con `np.bincount`. La codificación ajustada
+sobre todas las filas se guarda para transformar datos nuevos con
+`target_encode_frame`, agregando solamente una columna por variable.
+"""
+# %%
+target_encoded_cols = ["housing_seller_agency", "suburb_name"]
+require_columns(melb_combined_df, target_encoded_cols)
+target_encodings = {}
+target_encoded_df = pd.DataFrame(index=melb_combined_df.index)
+for col in target_encoded_cols:
+    target_encoded_df[f"{col}_target"], target_encodings[col] = (
+        target_encode_out_of_fold(melb_combined_df[col],
+                                  melb_combined_df["housing_price"],
+                                  nof_folds=5,
+                                  smoothing=10.0))
+target_encoded_df.describe()
+# %% [markdown]
+"""
 ### One-Hot Encoding
 Otro forma posible de obtener la matriz de *features* es por medio de la clase
 `OneHotEncoder` realizando la codificación sobre `categorical_cols`.
@@ -162,10 +1028,11 @@ estimator = neighbors.KNeighborsRegressor(n_neighbors=2)
 # %%
 missing_df = melb_combined_df[missing_cols]
 original_df = missing_df.dropna()
-all_df = np.hstack([missing_df, feature_matrix.todense()])
+all_df = np.hstack([missing_df, encoded_features])
 
 knn_missing_cols = impute_by(missing_df, missing_cols, estimator)
-knn_all_cols = impute_by(all_df, missing_cols, estimator)
+knn_all_cols, knn_all_cols_imputer = fit_impute_by(all_df, missing_cols,
+                                                   estimator)
 # %% [markdown]
 """
 Para la comparación se crean 3 *dataframes*:
@@ -201,15 +1068,25 @@ aseveración para la variable `housing_bulding_area`.
 # %% [markdown]
 """
 ### Con estandarizado
+Las columnas de `original_df`, `missing_df` y `all_df` se superponen, por lo que
+en lugar de ajustar un `StandardScaler` sobre cada una se utiliza `standardize`.
+Esta toma la media y la varianza de cada columna de `frame_statistics`, que las
+guarda por versión de los datos y nombre de columna. La versión es
+`data_version`, asignada al leer los archivos (momento en que se vacía la
+caché), seguida del subconjunto de filas o de la imputación cuando los valores
+cambian. Así, las columnas compartidas se recorren una única vez. Como resguardo
+ante versiones desactualizadas, cada columna guardada conserva una huella de
+unas pocas de sus filas, y se vuelve a calcular si esta no coincide.
 """
 # %%
-scaler = preprocessing.StandardScaler()
-original_scaled_df = pd.DataFrame(scaler.fit_transform(original_df),
-                                  columns=missing_cols)
-knn_scaled_missing_cols = impute_by(scaler.fit_transform(missing_df),
+all_cols = missing_cols + vectorizer.get_feature_names()
+original_scaled_df = pd.DataFrame(
+    standardize(original_df, f"{data_version}/complete_rows"),
+    columns=missing_cols)
+knn_scaled_missing_cols = impute_by(standardize(missing_df, data_version),
                                     missing_cols, estimator)
-knn_scaled_all_cols = impute_by(scaler.fit_transform(all_df), missing_cols,
-                                estimator)
+knn_scaled_all_cols = impute_by(standardize(all_df, data_version, all_cols),
+                                missing_cols, estimator)
 # %%
 imputations = [
     ("scaled original", original_scaled_df),
@@ -226,8 +1103,93 @@ escala en los ejes x e y. Por lo tanto, se optó por incluir la imputación con
 todas las *features* sin estandarizado previo a la matriz resultante de la
 sección anterior.
 """
+# %% [markdown]
+"""
+### Barrido de hiperparámetros
+Para comparar otras cantidades de vecinos, ponderaciones o conjuntos de
+*features* no es necesario repetir la imputación desde cero. `knn_imputation_sweep`
+busca una única vez los vecinos de cada fila con datos faltantes para la mayor
+cantidad de vecinos a evaluar, y obtiene cada configuración tomando los primeros
+*k* vecinos y ponderándolos de manera uniforme o por la inversa de su distancia.
+A diferencia de `impute_by`, cada columna se imputa en una única pasada a partir
+de las *features* codificadas, sin las iteraciones de `IterativeImputer`. El
+resultado es una tabla con una columna `method` que puede graficarse
+directamente con `plot_imputation_graph`.
+
+Al igual que en la comparación anterior, se incluye el conjunto `missing cols`,
+en el que cada columna se imputa a partir de la otra columna con datos
+faltantes. Como la búsqueda de vecinos requiere *features* completas, solo se
+utilizan los casos completos: las filas en las que ambas columnas son nulas no
+se imputan con este conjunto y conservan sus valores faltantes.
+
+**Nota:** la configuración `k=2` con ponderación `uniform` no reproduce la
+imputación `knn - all cols` de la sección anterior. `impute_by` utiliza
+`IterativeImputer` con `KNeighborsRegressor(n_neighbors=2)`, que además incluye
+la otra columna faltante entre las *features* y repite las imputaciones hasta
+converger, por lo que sus resultados difieren de los del barrido.
+"""
+# %%
+knn_sweep_df = knn_imputation_sweep(
+    missing_df,
+    {
+        "missing cols": missing_df,
+        "all cols": encoded_features,
+        "scaled all cols": scaled_encoded_features,
+    },
+    k_values=[1, 2, 3, 5, 8])
+knn_sweep_df
 # %%
-feature_matrix = np.hstack([feature_matrix.todense(), knn_all_cols])
+plot_imputation_graph(
+    pd.concat([
+        original_df.assign(method="original"),
+        knn_sweep_df[(knn_sweep_df["features"] == "all cols") &
+                     (knn_sweep_df["weights"] == "uniform")]
+    ]), missing_cols)
+# %% [markdown]
+"""
+### Evaluación de estrategias de imputación
+Los gráficos de densidad permiten comparar las distribuciones, pero no miden el
+error de cada imputación. Para ello, `evaluate_imputers` oculta una fracción de
+los valores conocidos de `housing_year_built` y `housing_building_area` con
+distintos patrones de datos faltantes: al azar (`mcar`), con mayor probabilidad
+en las viviendas más caras (`mar`), o en filas completas (`rows`). Luego imputa
+los valores ocultos con cada estrategia en varias repeticiones ejecutadas en
+paralelo, y reporta el RMSE y el MAE de cada columna junto al tiempo empleado.
+Las *features* son las codificadas estandarizadas de la matriz compartida, que
+no incluyen las columnas evaluadas. Su grafo de vecinos se calcula una única vez
+y, al igual que los valores evaluados, se publica junto a la matriz para que
+todas las repeticiones y estrategias basadas en KNN lo compartan sin copiarlo.
+
+`suburb_rental_dailyprice` no se evalúa: sus valores faltantes ya fueron
+completados con la media en `melbourne_exploration.ipynb`, por lo que parte de
+los valores ocultos serían esa misma media y la comparación favorecería a la
+estrategia `mean`.
+"""
+# %%
+evaluated_cols = missing_cols
+if set(evaluated_cols) & set(encoded_cols):
+    raise ValueError("The evaluated columns must not be encoded features")
+
+imputation_scores_df = evaluate_imputers(
+    melb_combined_df[evaluated_cols],
+    ENCODED_FEATURES_PATH,
+    "encoded_scaled",
+    neighbour_graph(scaled_encoded_features, k=20),
+    strategies=list(IMPUTATION_STRATEGIES),
+    patterns=["mcar", "mar", "rows"],
+    fraction=0.1,
+    nof_folds=5,
+    driver=melb_combined_df["housing_price"].to_numpy(),
+    n_jobs=os.cpu_count())
+# %%
+(
+    imputation_scores_df
+        .drop(columns="fold")
+        .groupby(["pattern", "strategy"])
+        .mean()
+)
+# %%
+feature_matrix = np.hstack([encoded_features, knn_all_cols])
 feature_matrix.shape
 # %% [markdown]
 """
@@ -242,8 +1204,9 @@ estandarización permite trabajar con variables medidas en distintas unidades y
 así dar el mismo peso a todas las variables.
 """
 # %%
-feature_matrix_standarized = preprocessing.StandardScaler().fit_transform(
-    feature_matrix)
+pca_scaler = fit_cached_scaler(feature_matrix, f"{data_version}/knn_imputed",
+                               vectorizer.get_feature_names() + missing_cols)
+feature_matrix_standarized = pca_scaler.transform(feature_matrix)
 # %% [markdown]
 """
 A continuación se muestra a modo de ejemplo el cambio de los valores antes y
@@ -255,7 +1218,9 @@ print('\nDespués de estandarizar \n%s' %feature_matrix_standarized[5])
 # %%
 _, nof_components = feature_matrix_standarized.shape
 pca = decomposition.PCA(n_components=nof_components)
-principal_components = pca.fit_transform(feature_matrix_standarized)
+with track_stage("pca", feature_matrix_standarized) as stage:
+    principal_components = pca.fit_transform(feature_matrix_standarized)
+    stage["shape_out"] = shape_of(principal_components)
 # %% [markdown]
 """
 Se muestra la varianza explicada por cada componente
@@ -311,6 +1276,27 @@ plt.tight_layout()
 plt.show()
 # %% [markdown]
 """
+### PCA sobre la matriz dispersa
+`decomposition.PCA` no puede centrar matrices dispersas, por lo que fue
+necesario convertir la salida de `DictVectorizer` en una matriz densa y
+estandarizarla con `StandardScaler` previamente. `implicit_pca` obtiene las
+mismas componentes directamente a partir de la matriz dispersa y del bloque
+denso de columnas imputadas, aplicando la media y el desvío de cada columna
+dentro de los productos matriciales de una SVD aleatorizada. De esta manera
+nunca se construye una copia densa y centrada de la matriz, lo que permitiría
+incluir variables categóricas con muchas categorías. A continuación se verifica
+que el resultado coincida con el `PCA` anterior salvo el signo de cada
+componente.
+"""
+# %%
+implicit_components, _, implicit_variance_ratio = implicit_pca(
+    vectorizer.transform(features), knn_all_cols, n_components=nof_components)
+(
+    np.allclose(np.abs(implicit_components), np.abs(principal_components)),
+    np.allclose(implicit_variance_ratio, explained_variance)
+)
+# %% [markdown]
+"""
 ## Composición del resultado
 Para finalizar, se crea un nuevo *dataframe* que contenga las codificaciones de
 las variables categóricas y numéricas, las imputaciones de columnas que
@@ -332,7 +1318,130 @@ encoded_melb_df = pd.DataFrame(
     data=np.hstack([
         feature_matrix,
         principal_components[:, :nof_selected_components]]),
-    columns=new_columns)
+    columns=new_columns,
+    index=melb_combined_df.index)
 encoded_melb_df
 # %%
 encoded_melb_df.to_csv("encoded_melb_df.csv", index=False)
+# %% [markdown]
+"""
+## Almacén de *features*
+`encoded_melb_df.csv` no conserva la identidad de cada venta, por lo que no
+puede combinarse con los conjuntos anteriores. Por ello, sus columnas se
+guardan también en el almacén local de *features* indexado por `sale_id` que
+inicia `combine_airbnb_dataset.ipynb`, separadas en grupos versionados: la
+codificación *one-hot*, los valores imputados, las componentes principales y la
+codificación por objetivo.
+Luego, `read_features` lee únicamente las columnas pedidas de cada grupo,
+aplicando los filtros al leer los archivos Parquet, y `lookup_features` obtiene
+las *features* de ventas puntuales.
+"""
+# %%
+nof_encoded_cols = len(vectorizer.get_feature_names())
+feature_group_cols = {
+    "encoded_onehot": new_columns[:nof_encoded_cols],
+    "imputed_values": missing_cols,
+    "pca_components": new_columns[nof_encoded_cols + len(missing_cols):],
+}
+for group, group_cols in feature_group_cols.items():
+    write_feature_group(encoded_melb_df[group_cols], FEATURE_STORE_DIR, group)
+write_feature_group(target_encoded_df, FEATURE_STORE_DIR, "target_encoded")
+# %%
+read_features(
+    FEATURE_STORE_DIR,
+    {
+        "encoded_onehot": ["housing_price"],
+        "imputed_values": None,
+        "pca_components": ["pca_0", "pca_1"],
+    },
+    filters=[("housing_price", ">", 1e6)])
+# %%
+lookup_features(FEATURE_STORE_DIR, "pca_components",
+                encoded_melb_df.index[:5])
+# %% [markdown]
+"""
+## Matriz compartida final
+Del mismo modo que la matriz codificada, `encoded_melb_df` completo, con las
+columnas imputadas y las componentes del `PCA`, se publica con
+`publish_feature_matrix` para que el entrenamiento de modelos, que suele
+ejecutarse en varios procesos o *notebooks* a la vez, lo mapee con
+`attach_feature_matrix` en lugar de obtener cada uno su propia copia.
+"""
+# %%
+ENCODED_MATRIX_PATH = "encoded_melb_df.mmap"
+
+publish_feature_matrix(
+    encoded_melb_df.to_numpy(),
+    ENCODED_MATRIX_PATH,
+    columns=new_columns,
+    groups={
+        "encoded": (0, nof_encoded_cols),
+        "imputed": (nof_encoded_cols, nof_encoded_cols + len(missing_cols)),
+        "pca": (nof_encoded_cols + len(missing_cols), len(new_columns)),
+    })
+
+shared_matrix, shared_header = attach_feature_matrix(ENCODED_MATRIX_PATH)
+feature_group(shared_matrix, shared_header, "imputed")
+# %% [markdown]
+"""
+## Modo incremental
+Para codificar nuevos lotes de ventas sin volver a ajustar el vectorizador, el
+imputador, el estandarizado y el `PCA`, estos se guardan junto a las columnas
+utilizadas y a la codificación por objetivo.
+"""
+# %%
+ENCODING_STATE_PATH = "encode_dataset_state.pkl"
+
+with open(ENCODING_STATE_PATH, "wb") as state_file:
+    pickle.dump(
+        {
+            "feature_cols": feature_cols,
+            "vectorizer": vectorizer,
+            "missing_cols": missing_cols,
+            "imputer": knn_all_cols_imputer,
+            "pca_scaler": pca_scaler,
+            "pca": pca,
+            "nof_selected_components": nof_selected_components,
+            "columns": new_columns,
+            "target_encodings": target_encodings,
+        }, state_file)
+# %% [markdown]
+"""
+Las particiones escritas por el modo incremental de
+`melbourne_exploration.ipynb` se codifican por medio de `append_encoded_batch`.
+Dado que un lote puede referirse a suburbios nuevos, la dimensión de suburbios
+se compone del conjunto original y todas sus particiones.
+"""
+# %%
+batch_id = "example"
+housing_batch_path = partition_path(MELB_HOUSING_FILTERED_PARTITIONS, batch_id)
+housing_batch_df = index_by_sale_id(
+    pd.read_csv(housing_batch_path, index_col=0), housing_batch_path)
+suburb_partitions_df = pd.concat([
+    pd.read_csv(os.path.join(MELB_SUBURB_FILTERED_PARTITIONS, partition),
+                index_col=0)
+    for partition in sorted(os.listdir(MELB_SUBURB_FILTERED_PARTITIONS))
+])
+all_suburbs_df = pd.concat([melb_suburb_df, suburb_partitions_df])
+
+with open(ENCODING_STATE_PATH, "rb") as state_file:
+    encoding_state = pickle.load(state_file)
+
+encoded_batch_df = append_encoded_batch(housing_batch_df, all_suburbs_df,
+                                        encoding_state)
+target_encoded_batch_df = target_encode_frame(
+    housing_batch_df.join(all_suburbs_df, on="suburb_id"),
+    encoding_state["target_encodings"])
+write_partition(encoded_batch_df, ENCODED_MELB_PARTITIONS, batch_id)
+write_partition(target_encoded_batch_df, TARGET_ENCODED_PARTITIONS, batch_id)
+encoded_batch_df.join(target_encoded_batch_df)
+# %% [markdown]
+"""
+## Instrumentación
+Las etapas más costosas de la codificación (lectura de los archivos `.csv`,
+`DictVectorizer`, imputación por `IterativeImputer` y `PCA`) fueron registradas
+por `track_stage`. A continuación se guarda el reporte de tiempos y memoria de
+cada una de ellas.
+"""
+# %%
+print(write_stage_report("encode_dataset_stages"))
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP service that answers the AirBnB enrichment of
+combine_airbnb_dataset.py on demand.
+
+At startup it loads the state saved by the notebook in ENRICHMENT_STATE_PATH
+(spatial index of the AirBnB listings, their descriptions and prices, and the
+mean daily price by postcode) and keeps it in memory. Concurrent requests are
+gathered into micro-batches that are answered with a single vectorized query of
+the index.
+
+Usage:
+    python enrichment_service.py --state combine_airbnb_state.pkl --port 8765
+
+Endpoints:
+    GET  /enrich?lat=-37.81&lon=144.96[&postcode=3000]
+    POST /enrich  with a JSON list of {"lat": ..., "lon": ..., "postcode": ...}
+    GET  /metrics
+"""
+import argparse
+import asyncio
+import json
+import pickle
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+
+EARTH_RADIUS_KM = 6371.0
+ENRICHMENT_STATE_PATH = "combine_airbnb_state.pkl"
+LATENCY_WINDOW = 10000
+MAX_BODY_BYTES = 1 << 20
+
+
+def load_enrichment_state(path: str) -> Dict[str, Any]:
+    """
+    Loads the state pickled by combine_airbnb_dataset.py at @path and returns
+    what the service needs to answer queries: the BallTree of the listings,
+    their descriptions and prices as numpy arrays, the mean daily price by
+    postcode, and the default number of neighbours.
+    """
+    with open(path, "rb") as state_file:
+        state = pickle.load(state_file)
+    col_to_join = state["col_to_join"]
+    locations_df = state["airbnb_locations"]
+    prices = state.get("airbnb_prices")
+    zipcode_df = state["airbnb_by_zipcode_df"]
+    return {
+        "index": state["location_index"],
+        "col_to_join": col_to_join,
+        "texts": locations_df[col_to_join].fillna("").to_numpy(dtype=object),
+        "prices": (np.full(len(locations_df), np.nan) if prices is None else
+                   np.asarray(prices, dtype=float)),
+        "postcode_prices": dict(
+            zip(zipcode_df["suburb_postcode"].astype(int),
+                zipcode_df["suburb_rental_dailyprice"].astype(float))),
+        "k": state["group_size"],
+    }
+
+
+def enrich_locations(state: Dict[str, Any], coordinates: np.array,
+                     postcodes: List[Optional[int]], k: int,
+                     radius_km: float) -> List[Dict[str, Any]]:
+    """
+    Returns the enrichment of every (latitude, longitude) row of @coordinates
+    in degrees: its @k nearest listings with their distance and description,
+    the count, mean and median price of the listings within @radius_km, and the
+    mean daily price of the postcode in @postcodes (None if unknown). The whole
+    batch is answered with one k-nearest and one radius query of the index in
+    @state.
+    """
+    nof_centers = len(coordinates)
+    centers_rad = np.deg2rad(coordinates)
+    distances, indices = state["index"].query(centers_rad, k=k)
+    radius_indices = state["index"].query_radius(centers_rad,
+                                                 r=radius_km / EARTH_RADIUS_KM)
+
+    counts = np.fromiter(map(len, radius_indices), dtype=np.int64,
+                         count=nof_centers)
+    rows = np.repeat(np.arange(nof_centers), counts)
+    values = state["prices"][np.concatenate(radius_indices).astype(np.int64)]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.bincount(rows, values, minlength=nof_centers) / counts
+    # Medians: sort by center and price, and take the middle of each run.
+    sorted_values = np.append(values[np.lexsort((values, rows))], np.nan)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    lower = np.where(counts > 0, starts + (counts - 1) // 2, len(values))
+    upper = np.where(counts > 0, starts + counts // 2, len(values))
+    medians = (sorted_values[lower] + sorted_values[upper]) / 2
+
+    def finite_or_none(value: float) -> Optional[float]:
+        return float(value) if np.isfinite(value) else None
+
+    return [{
+        "latitude": float(coordinates[row, 0]),
+        "longitude": float(coordinates[row, 1]),
+        "neighbours": [{
+            "index": int(index),
+            "distance_km": float(distance * EARTH_RADIUS_KM),
+            state["col_to_join"]: state["texts"][index],
+        } for index, distance in zip(indices[row], distances[row])],
+        "rental": {
+            "radius_km": radius_km,
+            "count": int(counts[row]),
+            "mean": finite_or_none(means[row]),
+            "median": finite_or_none(medians[row]),
+        },
+        "suburb_rental_dailyprice": state["postcode_prices"].get(
+            postcodes[row]),
+    } for row in range(nof_centers)]
+
+
+def parse_queries(queries: List[Dict[str, Any]]
+                  ) -> Tuple[np.array, List[Optional[int]]]:
+    """
+    Returns the coordinates as an array of (latitude, longitude) rows and the
+    postcodes of @queries, a list of mappings with keys lat, lon and optionally
+    postcode. Raises ValueError if a query is malformed or out of range.
+    """
+    if not isinstance(queries, list) or not queries:
+        raise ValueError("expected a non-empty list of queries")
+    try:
+        coordinates = np.array(
+            [[float(query["lat"]), float(query["lon"])] for query in queries])
+        postcodes = [
+            None if query.get("postcode") in (None, "") else int(
+                float(query["postcode"])) for query in queries
+        ]
+    except (KeyError, TypeError, ValueError, AttributeError) as error:
+        raise ValueError(f"malformed query: {error}")
+    if (not np.isfinite(coordinates).all()
+            or (np.abs(coordinates[:, 0]) > 90).any()
+            or (np.abs(coordinates[:, 1]) > 180).any()):
+        raise ValueError("coordinates out of range")
+    return coordinates, postcodes
+
+
+def new_counters() -> Dict[str, Any]:
+    """
+    Returns the counters updated by the service while it runs.
+    """
+    return {
+        "started": time.monotonic(),
+        "requests": 0,
+        "errors": 0,
+        "queries": 0,
+        "batches": 0,
+        "batched_queries": 0,
+        "latencies_ms": deque(maxlen=LATENCY_WINDOW),
+    }
+
+
+def metrics_snapshot(counters: Dict[str, Any],
+                     queue: asyncio.Queue) -> Dict[str, Any]:
+    """
+    Returns the throughput and latency figures of @counters, with latency
+    percentiles over the last LATENCY_WINDOW requests, and the number of
+    requests waiting in @queue.
+    """
+    uptime = time.monotonic() - counters["started"]
+    latencies = np.array(counters["latencies_ms"])
+    percentiles = (np.percentile(latencies, [50, 95, 99]) if len(latencies)
+                   else [None] * 3)
+    return {
+        "uptime_s": uptime,
+        "requests": counters["requests"],
+        "errors": counters["errors"],
+        "queries": counters["queries"],
+        "batches": counters["batches"],
+        "mean_batch_size": (counters["batched_queries"] / counters["batches"]
+                            if counters["batches"] else None),
+        "queued_requests": queue.qsize(),
+        "throughput_qps": counters["queries"] / uptime if uptime else None,
+        "latency_ms": {
+            f"p{q}": None if value is None else float(value)
+            for q, value in zip([50, 95, 99], percentiles)
+        },
+    }
+
+
+async def run_batcher(service: Dict[str, Any]) -> None:
+    """
+    Takes the pending requests of the queue of @service and answers them in
+    micro-batches: a batch is closed when it holds max_batch_size queries or
+    max_delay seconds after its first request arrived. Each batch is answered
+    by enrich_locations on the executor thread, so the event loop keeps
+    accepting requests meanwhile.
+    """
+    loop = asyncio.get_running_loop()
+    queue = service["queue"]
+    while True:
+        batch = [await queue.get()]
+        size = len(batch[0][0])
+        deadline = loop.time() + service["max_delay"]
+        while size < service["max_batch_size"]:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            size += len(item[0])
+
+        coordinates = np.vstack([item[0] for item in batch])
+        postcodes = [postcode for item in batch for postcode in item[1]]
+        try:
+            results = await loop.run_in_executor(
+                service["executor"], enrich_locations, service["state"],
+                coordinates, postcodes, service["k"], service["radius_km"])
+        except Exception as error:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            continue
+        service["counters"]["batches"] += 1
+        service["counters"]["batched_queries"] += size
+        start = 0
+        for item_coordinates, _, future in batch:
+            if not future.done():
+                future.set_result(results[start:start + len(item_coordinates)])
+            start += len(item_coordinates)
+
+
+async def enrich(service: Dict[str, Any],
+                 queries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Enqueues @queries for the batcher of @service and waits for their results.
+    """
+    coordinates, postcodes = parse_queries(queries)
+    future = asyncio.get_running_loop().create_future()
+    await service["queue"].put((coordinates, postcodes, future))
+    return await future
+
+
+async def route(service: Dict[str, Any], method: str, target: str,
+                body: bytes) -> Tuple[HTTPStatus, Any]:
+    """
+    Returns the status and JSON payload of the response to a @method request
+    to @target with @body.
+    """
+    url = urlsplit(target)
+    if url.path == "/metrics" and method == "GET":
+        return HTTPStatus.OK, metrics_snapshot(service["counters"],
+                                               service["queue"])
+    if url.path != "/enrich":
+        return HTTPStatus.NOT_FOUND, {"error": "not found"}
+    if method == "GET":
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        return HTTPStatus.OK, (await enrich(service, [params]))[0]
+    if method == "POST":
+        try:
+            queries = json.loads(body or b"null")
+        except json.JSONDecodeError as error:
+            raise ValueError(f"invalid JSON: {error}")
+        return HTTPStatus.OK, {"results": await enrich(service, queries)}
+    return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "method not allowed"}
+
+
+async def handle_connection(service: Dict[str, Any],
+                            reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter) -> None:
+    """
+    Serves the HTTP/1.1 requests of one connection, keeping it open between
+    requests unless the client asks to close it.
+    """
+    counters = service["counters"]
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            start = time.perf_counter()
+            method, target, version = request_line.decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            if length > MAX_BODY_BYTES:
+                status, payload = (HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                   {"error": "request too large"})
+                keep_alive = False
+            else:
+                body = await reader.readexactly(length) if length else b""
+                keep_alive = (version == "HTTP/1.1" and
+                              headers.get("connection", "").lower() != "close")
+                try:
+                    status, payload = await route(service, method, target, body)
+                except ValueError as error:
+                    status, payload = HTTPStatus.BAD_REQUEST, {
+                        "error": str(error)
+                    }
+
+            content = json.dumps(payload).encode()
+            writer.write(
+                (f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                 "Content-Type: application/json\r\n"
+                 f"Content-Length: {len(content)}\r\n"
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                 "\r\n").encode("latin-1") + content)
+            await writer.drain()
+
+            counters["requests"] += 1
+            if status == HTTPStatus.OK and target.startswith("/enrich"):
+                counters["queries"] += (len(payload["results"])
+                                        if "results" in payload else 1)
+                counters["latencies_ms"].append(
+                    (time.perf_counter() - start) * 1000)
+            elif status != HTTPStatus.OK:
+                counters["errors"] += 1
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        counters["errors"] += 1
+    finally:
+        writer.close()
+
+
+async def serve(state_path: str, host: str, port: int, k: Optional[int],
+                radius_km: float, max_batch_size: int,
+                max_delay_ms: float) -> None:
+    """
+    Loads the state at @state_path and serves the enrichment on @host:@port
+    until cancelled, with @k neighbours per query (the group_size of the state
+    if not given) and rental statistics within @radius_km. Micro-batches hold
+    at most @max_batch_size queries and wait at most @max_delay_ms.
+    """
+    state = load_enrichment_state(state_path)
+    service = {
+        "state": state,
+        "k": k or state["k"],
+        "radius_km": radius_km,
+        "max_batch_size": max_batch_size,
+        "max_delay": max_delay_ms / 1000,
+        "queue": asyncio.Queue(),
+        "counters": new_counters(),
+        "executor": ThreadPoolExecutor(max_workers=1),
+    }
+    batcher = asyncio.create_task(run_batcher(service))
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(service, reader, writer),
+        host, port)
+    print(f"Serving {len(state['texts'])} listings on "
+          f"http://{host}:{port}/enrich")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher.cancel()
+        service["executor"].shutdown(wait=False)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Serves the AirBnB enrichment of Melbourne sales.")
+    parser.add_argument("--state", default=ENRICHMENT_STATE_PATH)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--k", type=int, default=None)
+    parser.add_argument("--radius-km", type=float, default=1.0)
+    parser.add_argument("--max-batch-size", type=int, default=256)
+    parser.add_argument("--max-delay-ms", type=float, default=2.0)
+    args = parser.parse_args()
+    try:
+        asyncio.run(
+            serve(args.state, args.host, args.port, args.k, args.radius_km,
+                  args.max_batch_size, args.max_delay_ms))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()